@@ -45,10 +45,8 @@ export HOMEBREW_CASK_OPTS='--appdir=/Applications'
 export EDITOR='code --wait'
 # set antigen path
 export ADOTDIR=$HOME/.dotfiles/antigen
-# Init jenv
-if [ -x "$(command -v jenv)" ]; then
-  eval "$(jenv init -)"
-fi
+# Init jenv (and other slow inits) only when first used, stubs are generated by dotfyles.py
+[ -r ~/.profile.lazy ] && source ~/.profile.lazy
 
 #############################################################
 # SHELL ALIAS
@@ -160,10 +158,16 @@ function bundleid()
 #########################################
 # emulates the commands below like they would natively be in docker
 function jenv() {
+  # the deferred 'jenv init' (see ~/.profile.lazy) goes first, 'jenv shell' needs it
+  if command -v _dotfyles_lazy_jenv > /dev/null 2>&1; then
+    _dotfyles_lazy_jenv
+  fi
   if command -v "jenv-$1" > /dev/null 2>&1; then
     subcommand=$1
     shift
     jenv-$subcommand $@
+  elif command -v _dotfyles_init_jenv > /dev/null 2>&1; then
+    _dotfyles_init_jenv "$@"
   else
     /usr/local/bin/jenv $@
   fi
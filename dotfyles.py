@@ -27,6 +27,33 @@ import urllib
 import json
 import datetime
 import time
+import concurrent.futures
+import shlex
+import base64
+import atexit
+import plistlib
+import tarfile
+import tempfile
+import queue
+import threading
+import contextlib
+import stat
+import math
+import mmap
+import heapq
+import importlib.util
+import cProfile
+import pstats
+import tracemalloc
+import filecmp
+import select
+import hashlib
+import functools
+import signal
+import fcntl
+import inspect
+import types
+import glob
 
 os.environ["PYTHONIOENCODING"] = "utf-8"
 DEV_NULL = open(os.devnull, 'w')
@@ -47,34 +74,167 @@ SNEK = _emoji('U+1F40D')
 GRASS = _emoji('U+1F33F')
 WARN = _emoji('U+26A0')
 
-def _safe_print(msg, **kwargs):
+# Everything we print goes through a queue to a background writer thread, so
+# a slow terminal or pipe doesn't hold the steps back. Lines logged inside a
+# _log_group() (every step is one) are queued together when the group ends,
+# which keeps the output of parallel work from interleaving. Prompting writes
+# out what the groups held so far first.
+LOG_QUIET, LOG_NORMAL, LOG_VERBOSE = 0, 1, 2
+LOG_LEVEL = LOG_NORMAL
+LOG_JSON = None
+LOG_QUEUE = queue.Queue()
+LOG_WRITER = None
+# False once stdout is gone
+LOG_STDOUT = True
+LOG_THREAD = threading.local()
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+def _stdout_gone():
+    global LOG_STDOUT
+    # the pipe or terminal we wrote to went away (e.g. '| head', a dropped ssh
+    # session): keep going without output, pointing the fd at /dev/null so the
+    # interpreter doesn't fail flushing it again at exit
+    LOG_STDOUT = False
     try:
-        print(msg, **kwargs)
-    except UnicodeEncodeError:
-        print(msg.encode('ascii','ignore'), **kwargs)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    except (OSError, ValueError):
+        pass
+
+def _log_write(groups):
+    for group in groups:
+        for kind, level, msg, end, timestamp in group:
+            if level <= LOG_LEVEL and LOG_STDOUT:
+                try:
+                    try:
+                        sys.stdout.write(msg + end)
+                    except UnicodeEncodeError:
+                        sys.stdout.write((msg + end).encode('ascii','ignore').decode('ascii'))
+                except (OSError, ValueError):
+                    _stdout_gone()
+            if LOG_JSON is not None:
+                record = {
+                    'time': datetime.datetime.fromtimestamp(timestamp).isoformat(),
+                    'kind': kind,
+                    # warnings are logged at the quiet level, so that they always show
+                    'level': 'warn' if kind == 'warn' else ('quiet', 'normal', 'verbose')[level],
+                    'message': ANSI_ESCAPE.sub('', msg).strip(),
+                }
+                LOG_JSON.write(json.dumps(record) + '\n')
+
+    if LOG_STDOUT:
+        try:
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            _stdout_gone()
+    if LOG_JSON is not None: LOG_JSON.flush()
+
+def _log_writer():
+    while True:
+        groups = [ LOG_QUEUE.get() ]
+        # drain whatever else is waiting so we flush once per batch
+        while True:
+            try:
+                groups.append(LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        # whatever happens, _log_flush() must not wait on these forever
+        try:
+            _log_write(groups)
+        except Exception:
+            pass
+        finally:
+            for _ in groups: LOG_QUEUE.task_done()
+
+def _log_enqueue(group):
+    global LOG_WRITER
+    if LOG_WRITER is None:
+        LOG_WRITER = threading.Thread(target=_log_writer, name='log-writer', daemon=True)
+        LOG_WRITER.start()
+    LOG_QUEUE.put(group)
+
+def _log(kind, level, msg, end='\n'):
+    record = (kind, level, msg, end, time.time())
+    groups = getattr(LOG_THREAD, 'groups', None)
+    if groups:
+        groups[-1][1].append(record)
+    else:
+        _log_enqueue([record])
+
+def _log_flush():
+    # waits until everything logged so far is written, e.g. before prompting,
+    # along with what this thread's groups are holding (unless they're discarded)
+    groups = getattr(LOG_THREAD, 'groups', None)
+    if groups and not any(discard for discard, _ in groups):
+        held = [ record for _, group in groups for record in group ]
+        for _, group in groups:
+            del group[:]
+        if held:
+            _log_enqueue(held)
+    if LOG_WRITER is not None:
+        LOG_QUEUE.join()
+
+@contextlib.contextmanager
+def _log_group(discard=False):
+    if not hasattr(LOG_THREAD, 'groups'):
+        LOG_THREAD.groups = []
+    LOG_THREAD.groups.append((discard, []))
+    try:
+        yield
+    finally:
+        _, group = LOG_THREAD.groups.pop()
+        if discard:
+            pass
+        elif LOG_THREAD.groups:
+            LOG_THREAD.groups[-1][1].extend(group)
+        elif group:
+            _log_enqueue(group)
+
+def _log_setup(level=LOG_NORMAL, json_path=None):
+    global LOG_LEVEL, LOG_JSON
+    LOG_LEVEL = level
+    if json_path:
+        # appending, so parallel workers can share the same file
+        LOG_JSON = open(json_path, 'a')
+    atexit.register(_log_flush)
+
+def _safe_print(msg, kind='print', level=LOG_NORMAL, end='\n', flush=False):
+    _log(kind, level, str(msg), end)
+    if flush:
+        _log_flush()
 
 def _safe_input(msg):
+    _log_flush()
     try:
         return input(msg)
     except UnicodeEncodeError:
         return input(msg.encode('ascii','ignore'))
 
 def _safe_getpass(msg):
+    _log_flush()
     try:
         return getpass.getpass(msg)
     except UnicodeEncodeError:
         return getpass.getpass(msg.encode('ascii','ignore'))
 
 def _snek(msg):
-    _safe_print('\n' + SNEK + ' ' + msg + '\n')
+    _safe_print('\n' + SNEK + ' ' + msg + '\n', kind='snek')
 
 def _grass(msg):
-    _safe_print('\n' + GRASS + ' ' + msg + '')
+    _safe_print('\n' + GRASS + ' ' + msg + '', kind='grass')
 
 def _ok(msg=""):
-    _safe_print(CGREEN + "[ok]" + CRESET + " " + msg)
+    _safe_print(CGREEN + "[ok]" + CRESET + " " + msg, kind='ok')
+
+def _question(msg, pwd=False, yN=False, Yn=False, default='', key=None):
+    # unattended runs take answers from the --answers file instead of prompting
+    if ANSWERS is not None:
+        answer = ANSWERS.get(key) if key else None
+        if yN or Yn:
+            return Yn if answer is None else (str(answer).lower() in {'true', 'yes', 'y', 'ye', '1'})
+        return default if answer is None else str(answer)
 
-def _question(msg, pwd=False, yN=False, Yn=False, default=''):
     msg = CMAGENTA + "¿" + CRESET + " " + msg
     if pwd:
         return _safe_getpass(msg + ": ")
@@ -92,18 +252,46 @@ def _question(msg, pwd=False, yN=False, Yn=False, default=''):
         return _safe_input(msg + ": ")
 
 def _info(msg, **kwargs):
-    _safe_print(CCYAN + "¡" + CRESET + " " + msg, **kwargs)
+    _safe_print(CCYAN + "¡" + CRESET + " " + msg, kind='info', **kwargs)
 
 def _warn(msg, **kwargs):
-    _safe_print(CYELLOW + WARN + CRESET + " " + msg, **kwargs)
+    _safe_print(CYELLOW + WARN + CRESET + " " + msg, kind='warn', level=LOG_QUIET, **kwargs)
+
+def _debug(msg, **kwargs):
+    _safe_print("  " + msg, kind='debug', level=LOG_VERBOSE, **kwargs)
 
 
 #########################
 # Lib helper functions
 #
+def _rooted(path):
+    # paths of the target machine are moved under --root when staging, the repo stays where it is
+    if not ROOT_PATH or path.startswith(REPO_PATH + os.sep):
+        return path
+    if path == ROOT_PATH or path.startswith(ROOT_PATH + os.sep):
+        return path
+    return os.path.join(ROOT_PATH, path.lstrip(os.sep))
+
+def _simulated():
+    # nothing really runs when staging under --root or auditing with --verify
+    return bool(ROOT_PATH) or EXPECTED is not None
+
+def _repo_output(relative_fpath):
+    # files we generate into the repo go to its mirror under --root when staging,
+    # so a staged run leaves the live checkout alone
+    path = os.path.join(REPO_PATH, relative_fpath)
+    return os.path.join(ROOT_PATH, path.lstrip(os.sep)) if ROOT_PATH else path
+
+def _repo_input(relative_fpath):
+    # what an earlier staged run generated, or else the checkout's own
+    path = _repo_output(relative_fpath)
+    return path if os.path.exists(path) else os.path.join(REPO_PATH, relative_fpath)
+
 def _abspath(relative_fpath):
-    if '~' in relative_fpath:
-        return os.path.expanduser(relative_fpath)
+    if relative_fpath.startswith('~'):
+        return _rooted(os.path.join(USER_PATH, relative_fpath[1:].lstrip('/')))
+    elif os.path.isabs(relative_fpath):
+        return _rooted(relative_fpath)
     else:
         return os.path.abspath(relative_fpath)
 
@@ -111,13 +299,18 @@ def _create_symlink(src, dst):
     src = _abspath(src)
     dst = _abspath(dst)
 
-    # return None if the src path doesnt exist
-    if not os.path.exists(src):
+    # return None if the src path doesnt exist (files generated into the repo may only be staged)
+    if not os.path.exists(src) and not (src.startswith(REPO_PATH + os.sep) and os.path.exists(_repo_output(os.path.relpath(src, REPO_PATH)))):
         return None
 
+    # when auditing we only note the link, and hand back the src since that's what dst should read as
+    if EXPECTED is not None:
+        EXPECTED.append(('symlink', src, dst))
+        return src
+
     # create path to file if dst doesnt exist
     if not os.path.exists(os.path.dirname(dst)):
-        os.makedirs(dst)
+        os.makedirs(os.path.dirname(dst))
 
     # if the paths are different we will force removal
     if os.path.realpath(dst) != src:
@@ -134,6 +327,7 @@ def _create_symlink(src, dst):
 
         # after removing we add again
         os.symlink(src, dst)
+        _journal_file('symlink', src=src, dst=dst)
 
     # we return the dst
     return dst
@@ -147,6 +341,10 @@ def _symlink_to_home(src, dst=None):
 def _local_with_brew_check(pkg):
     brew = local.get('brew','/usr/local/bin/brew')
 
+    # the prefetched inventory saves us a 'brew ls' per tool
+    if pkg in _prefetched('brew_inventory', set()):
+        return local.get(pkg, '/usr/local/bin/'+pkg)
+
     brew_has_pkg = brew['ls', '--versions', pkg].run(retcode=None)
     if brew_has_pkg[0] == 1:
         _info("Installing '" + pkg +"' terminal tool")
@@ -156,14 +354,246 @@ def _local_with_brew_check(pkg):
 
     return local.get(pkg, '/usr/local/bin/'+pkg)
 
+def _write_file(filepath, data):
+    filepath = _abspath(filepath)
+    if EXPECTED is not None:
+        EXPECTED.append(('file', filepath, data))
+        return
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    if os.path.islink(filepath):
+        # through the link, it's the file it points to that we manage
+        with open(filepath, mode) as f:
+            f.write(data)
+    else:
+        # written next to it and moved over, so nobody (e.g. a parallel --homes worker) reads it half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.dotfyles-')
+        # bytes are written as they are (e.g. binary plists), text as utf-8
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.chmod(tmp_path, stat.S_IMODE(os.stat(filepath).st_mode) if os.path.exists(filepath) else 0o644)
+        os.replace(tmp_path, filepath)
+    data = data if isinstance(data, bytes) else data.encode('utf-8')
+    _journal_file('write', path=filepath, data=base64.b64encode(data).decode('ascii'))
+
+def _touch(filepath):
+    filepath = _abspath(filepath)
+    if EXPECTED is not None:
+        EXPECTED.append(('file', filepath, None))
+        return
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    open(filepath, 'a').close()
+    _journal_file('touch', path=filepath)
+
+def _copy_file(src, dst):
+    src = _abspath(src)
+    dst = _abspath(dst)
+
+    # return None if the src path doesnt exist
+    if not os.path.exists(src):
+        return None
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if EXPECTED is not None:
+        EXPECTED.append(('copy', src, dst))
+        return dst
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.dotfyles-')
+    os.close(fd)
+    shutil.copy(src, tmp_path)
+    os.replace(tmp_path, dst)
+    _journal_file('copy', src=src, dst=dst)
+    return dst
+
+def _same_file(src, dst):
+    # size and mtime settle most files, only what is left gets hashed (copies keep the mtime)
+    src_stat, dst_stat = src.stat(), dst.stat()
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    # one second of slack, for filesystems (like cloud mounts) that round mtimes
+    if abs(src_stat.st_mtime_ns - dst_stat.st_mtime_ns) < 1e9:
+        return True
+    if _sha256_file(src.path) != _sha256_file(dst.path):
+        return False
+    os.utime(dst.path, ns=(dst_stat.st_atime_ns, src_stat.st_mtime_ns))
+    return True
+
+def _sync_tree(src, dst):
+    """Makes dst a copy of the src tree, copying only what changed and removing what is gone."""
+    src = _abspath(src)
+    dst = _abspath(dst)
+    stats = collections.Counter()
+    if not os.path.isdir(src):
+        return stats
+    if EXPECTED is not None:
+        # each file is checked like a copy of its own
+        for dirpath, _, filenames in os.walk(src):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                EXPECTED.append(('copy', path, os.path.join(dst, os.path.relpath(path, src))))
+                stats['files'] += 1
+        return stats
+
+    def remove(entry):
+        if entry.is_dir(follow_symlinks=False): shutil.rmtree(entry.path)
+        else: os.remove(entry.path)
+        stats['removed'] += 1
+
+    def sync(src_dir, dst_dir):
+        os.makedirs(dst_dir, exist_ok=True)
+        existing = { e.name: e for e in os.scandir(dst_dir) }
+        for entry in os.scandir(src_dir):
+            target = existing.pop(entry.name, None)
+            if target is not None and entry.is_dir() != target.is_dir(follow_symlinks=False):
+                remove(target)
+                target = None
+
+            if entry.is_dir():
+                sync(entry.path, os.path.join(dst_dir, entry.name))
+            elif target is None or not _same_file(entry, target):
+                # copied next to it first, so apps never see half a file
+                tmp_path = os.path.join(dst_dir, '.dotfyles-' + entry.name)
+                shutil.copy2(entry.path, tmp_path)
+                os.replace(tmp_path, os.path.join(dst_dir, entry.name))
+                stats['copied'] += 1
+                stats['bytes'] += entry.stat().st_size
+            stats['files'] += not entry.is_dir()
+
+        for stale in existing.values():
+            remove(stale)
+
+    sync(src, dst)
+    if stats['copied'] or stats['removed']:
+        _journal_file('sync', src=src, dst=dst)
+    return stats
+
 def _wait_for_file(filepath):
     filepath = _abspath(filepath)
-    while not os.path.exists(filepath):
+    # nothing is going to show up when we don't really run anything
+    while not os.path.exists(filepath) and not _simulated():
+        # waiting is bounded by the step and run budgets, like commands are
+        timeout, scope, step = _timeout_for(None)
+        if timeout is not None and timeout <= 0:
+            raise CommandTimeout("waiting for '" + filepath + "'", None, scope, step)
         time.sleep(1)
 
-def _download_file(url, filepath=None):
-    filepath = _abspath(os.path.join('.', url.split("/")[-1])) if filepath is not None else _abspath(filepath)
-    urllib.request.urlretrieve(url, filepath)
+# downloads are cached by content for whoever runs us, shared by every run and --home
+DOWNLOADS_CACHE_PATH = os.path.expanduser('~/.cache/dotfyles/downloads')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def _download_lock(url_key):
+    # flock, so a run that dies doesn't leave the lock behind
+    lock_path = os.path.join(DOWNLOADS_CACHE_PATH, 'partial', url_key + '.lock')
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _cached_blob(url_path, sha256):
+    known = sha256
+    if known is None and os.path.exists(url_path):
+        with open(url_path, 'r') as f:
+            known = f.read().strip()
+    if known and os.path.exists(os.path.join(DOWNLOADS_CACHE_PATH, 'blobs', known)):
+        return os.path.join(DOWNLOADS_CACHE_PATH, 'blobs', known)
+    return None
+
+def _cached_download(url, sha256=None, fresh=False):
+    """Path of url's content in the cache, downloading (or resuming) it if it isn't there (or fresh is asked for)."""
+    url_key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    url_path = os.path.join(DOWNLOADS_CACHE_PATH, 'urls', url_key)
+    blob_path = None if fresh else _cached_blob(url_path, sha256)
+    if blob_path is not None:
+        _debug("Using cached '" + url + "'")
+        return blob_path
+
+    # every download writes its own file, and only takes over the partial one
+    # a stopped download left (to resume it with a Range request) under the lock
+    part_path = os.path.join(DOWNLOADS_CACHE_PATH, 'partial', url_key)
+    with _download_lock(url_key):
+        # someone else may have finished it while we waited
+        blob_path = None if fresh else _cached_blob(url_path, sha256)
+        if blob_path is not None:
+            return blob_path
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(part_path), prefix=url_key + '.')
+        os.close(fd)
+        if os.path.exists(part_path):
+            os.replace(part_path, tmp_path)
+
+    try:
+        offset = os.path.getsize(tmp_path)
+        _debug("Downloading '" + url + "'" + ((" from byte " + str(offset)) if offset else ''))
+        headers = { 'Range': 'bytes=' + str(offset) + '-' } if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=30) as r:
+            # 416 means we already have all of it
+            if r.status_code != 416:
+                r.raise_for_status()
+                with open(tmp_path, 'ab' if r.status_code == 206 else 'wb') as f:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+    except BaseException:
+        # kept for the next try, unless another stopped download already left more
+        with _download_lock(url_key):
+            if os.path.getsize(tmp_path) > (os.path.getsize(part_path) if os.path.exists(part_path) else 0):
+                os.replace(tmp_path, part_path)
+            else:
+                os.remove(tmp_path)
+        raise
+
+    digest = _sha256_file(tmp_path)
+    if sha256 is not None and digest != sha256:
+        os.remove(tmp_path)
+        raise ValueError("Checksum mismatch for '" + url + "': expected " + sha256 + ", got " + digest)
+
+    blob_path = os.path.join(DOWNLOADS_CACHE_PATH, 'blobs', digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.makedirs(os.path.dirname(url_path), exist_ok=True)
+    with _download_lock(url_key):
+        os.replace(tmp_path, blob_path)
+        with open(url_path + '.tmp', 'w') as f:
+            f.write(digest)
+        os.replace(url_path + '.tmp', url_path)
+    return blob_path
+
+def _download_file(url, filepath=None, sha256=None, fresh=False):
+    # defaults to the current dir, and directories get the file's name from the url
+    filepath = filepath if filepath is not None else url.split("/")[-1]
+    if filepath.endswith('/') or os.path.isdir(_abspath(filepath)):
+        filepath = os.path.join(filepath, url.split("/")[-1])
+    filepath = _abspath(filepath)
+    if EXPECTED is not None:
+        return filepath
+
+    blob_path = _cached_download(url, sha256, fresh)
+    # copied next to the destination first, so it shows up there in one go
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.dotfyles-')
+    os.close(fd)
+    shutil.copyfile(blob_path, tmp_path)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, filepath)
+    _journal_file('download', url=url, path=filepath)
+    return filepath
+
+def _download_files(downloads, fresh=False):
+    """Downloads (url, filepath[, sha256]) tuples in parallel, returns their paths in the same order."""
+    # a None filepath only fetches into the cache, and gets the path there
+    def download(url, filepath, sha256=None):
+        return _cached_download(url, sha256, fresh) if filepath is None else _download_file(url, filepath, sha256, fresh)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        return list(pool.map(lambda d: download(*d), downloads))
 
 def _user_defaults(defaults):
     return os.path.join(_abspath('~/Library/Preferences/'), defaults + '.plist')
@@ -178,6 +608,1569 @@ def _check_output_zsh(cmd):
     output = output.decode('utf-8')
     return output
 
+
+#########################
+# Commands
+#
+# Steps build commands with plumbum's syntax (local['defaults']['write', ...].run()),
+# but they are handed out by _Machine so every execution goes through _execute().
+# That gives us a single place to record, redirect or skip what the steps do.
+
+JOURNAL = None
+EXPECTED = None
+
+COMMAND_TIMEOUTS = {
+    # program: seconds, for the ones known to hang
+    'softwareupdate': 2*60*60,
+    'brew': 60*60,
+    'mas': 60*60,
+    'mdutil': 30*60,
+}
+KILL_GRACE = 5
+RUN_DEADLINE = None
+STEP_DEADLINES = []
+# the steps that timed out (or needed one that did), the run goes on without them
+FAILED_STEPS = []
+
+READONLY_COMMANDS = {
+    # program: subcommands or flags that only read (None means the whole program)
+    'which': None,
+    'ls': None,
+    'df': None,
+    'csrutil': None,
+    'caffeinate': None,
+    'defaults': {'read', 'read-type', 'export', 'domains', 'find'},
+    'scutil': {'--get'},
+    'brew': {'ls', 'list', 'check', '--prefix', '--versions'},
+    'mas': {'account', 'list'},
+    'dockutil': {'--list'},
+    'code': {'--list-extensions'},
+    'diskutil': {'info', 'list'},
+    'osascript': {'loginitems-ls'},
+}
+
+class _Command(object):
+    def __init__(self, argv, stdin_cmd=None):
+        self.argv = argv
+        self.stdin_cmd = stdin_cmd
+
+    def __getitem__(self, args):
+        if not isinstance(args, (tuple, list)):
+            args = [args]
+        argv = list(self.argv)
+        for arg in args:
+            argv.extend(arg.argv if isinstance(arg, _Command) else [str(arg)])
+        return _Command(argv, self.stdin_cmd)
+
+    def __or__(self, other):
+        return _Command(other.argv, stdin_cmd=self)
+
+    def __call__(self, *args, **kwargs):
+        return self.run(args, **kwargs)[1]
+
+    def __str__(self):
+        cmdline = ' '.join(shlex.quote(arg) for arg in self.argv)
+        return (str(self.stdin_cmd) + ' | ' + cmdline) if self.stdin_cmd else cmdline
+
+    def run(self, args=(), **kwargs):
+        return _execute(self[args], **kwargs)
+
+    def popen(self, args=(), **kwargs):
+        if isinstance(args, str):
+            args = [args]
+        return _spawn(self[args], **kwargs)
+
+class _Machine(object):
+    def __getitem__(self, name):
+        return _Command([name])
+
+    def get(self, *names):
+        for name in names:
+            if shutil.which(name) or os.path.exists(name):
+                return _Command([name])
+        return _Command([names[-1]])
+
+def _plumbum(cmd):
+    plumbum_cmd = plumbum.local[cmd.argv[0]][cmd.argv[1:]]
+    if cmd.stdin_cmd is not None:
+        plumbum_cmd = _plumbum(cmd.stdin_cmd) | plumbum_cmd
+    return plumbum_cmd
+
+def _program(argv):
+    return (argv[1:] if argv[:1] == ['sudo'] and len(argv) > 1 else argv)[0]
+
+def _is_readonly(argv):
+    argv = argv[1:] if argv[:1] == ['sudo'] else argv
+    program, args = os.path.basename(argv[0]), argv[1:]
+
+    # 'git config [-f file|--global] key' reads, adding a value writes
+    if program == 'git' and args[:1] == ['config']:
+        positional, skip = [], False
+        for arg in args[1:]:
+            if skip: skip = False
+            elif arg == '-f': skip = True
+            elif not arg.startswith('-'): positional.append(arg)
+        return len(positional) == 1
+
+    if program not in READONLY_COMMANDS:
+        return False
+    subcommands = READONLY_COMMANDS[program]
+    # scripts (e.g. loginitems-ls) are run by their path
+    return subcommands is None or any(os.path.basename(a) in subcommands for a in args[:2])
+
+def _is_readonly_cmd(cmd):
+    return _is_readonly(cmd.argv) and (cmd.stdin_cmd is None or _is_readonly_cmd(cmd.stdin_cmd))
+
+def _journal(op, **entry):
+    if JOURNAL is not None:
+        entry['op'] = op
+        JOURNAL.append(entry)
+
+def _journal_file(op, **entry):
+    # files written under a staging root are already the result, only live changes are journaled
+    if not ROOT_PATH:
+        _journal(op, **entry)
+
+def _unrooted(arg):
+    # staged commands are replayed on the target, where nothing lives under --root
+    if not ROOT_PATH:
+        return arg
+    return arg.replace(ROOT_PATH + os.sep, os.sep) if arg != ROOT_PATH else os.sep
+
+def _journal_command(cmd):
+    if JOURNAL is not None and not _is_readonly(cmd.argv):
+        # relative arguments (e.g. '--file=.Brewfile') only mean something from where we ran them
+        cwd = _unrooted(os.getcwd())
+        if cmd.stdin_cmd is not None:
+            _journal('shell', cmdline=_unrooted(str(cmd)), cwd=cwd)
+        else:
+            _journal('run', argv=[ _unrooted(a) for a in cmd.argv ], cwd=cwd)
+
+class _NullProcess(object):
+    # stands in for the processes we don't start when staging
+    returncode = 0
+    pid = None
+
+    def poll(self): return 0
+    def wait(self, timeout=None): return 0
+    def communicate(self, input=None, timeout=None): return ('', '')
+    def terminate(self): pass
+    def kill(self): pass
+
+class CommandTimeout(Exception):
+    def __init__(self, cmdline, timeout, scope, step=None):
+        self.cmdline, self.timeout, self.scope, self.step = cmdline, timeout, scope, step
+        budget = (step + ' ' if step else '') + scope + ' budget'
+        if timeout is None:
+            msg = "'" + cmdline + "' ran out of the " + budget
+        else:
+            msg = "'" + cmdline + "' timed out after " + str(round(timeout)) + "s (" + budget + ")"
+        super().__init__(msg)
+
+def _timeout_for(program, timeout=None):
+    """Seconds a command may still run, with the budget (command, step or run) that limits it."""
+    now = time.time()
+    budgets = [ (timeout, 'command', None), (COMMAND_TIMEOUTS.get(program), 'command', None) ]
+    budgets += [ (deadline - now, 'step', name) for deadline, name in STEP_DEADLINES ]
+    budgets += [ (RUN_DEADLINE - now, 'run', None) ] if RUN_DEADLINE is not None else []
+    budgets = [ b for b in budgets if b[0] is not None ]
+    return min(budgets, key=lambda b: b[0]) if budgets else (None, None, None)
+
+def _kill_group(proc, privileged=False):
+    """Kills proc and everything it started, False if it's still running after that."""
+    # whatever ignores SIGTERM for KILL_GRACE seconds gets SIGKILL
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            # either everything is gone or it's not in its own group (foreground commands)
+            if proc.poll() is None: proc.send_signal(sig)
+        except PermissionError:
+            # started with sudo, only root (our privileged helper) can signal it
+            try:
+                result, = _privileged([{ 'kill': proc.pid, 'signal': int(sig) }]) if privileged else [{ 'error': 'not ours' }]
+            except RuntimeError as e:
+                result = { 'error': str(e) }
+            if 'error' in result:
+                _warn("Can't kill pid " + str(proc.pid) + ", it belongs to another user")
+                return proc.poll() is not None
+        try:
+            proc.wait(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            pass
+    return proc.poll() is not None
+
+def _run_bounded(cmd, timeout, scope, step, retcode=0, **kwargs):
+    if timeout <= 0:
+        raise CommandTimeout(str(cmd), None, scope, step)
+
+    # in its own process group so we can kill everything it started, unless it
+    # is in the foreground where it has to keep the terminal
+    if kwargs.get('stdout', subprocess.PIPE) is not None:
+        kwargs['preexec_fn'] = os.setpgrp
+    proc = _plumbum(cmd).popen(**kwargs)
+
+    # killing only the process (like plumbum's timeout does) would leave us
+    # waiting on the output of whatever it started, so a watchdog kills the group
+    expired = threading.Event()
+    def expire():
+        expired.set()
+        _kill_group(proc)
+    watchdog = threading.Timer(timeout, expire)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        ret = plumbum.commands.processes.run_proc(proc, retcode)
+    except plumbum.commands.processes.ProcessExecutionError:
+        if not expired.is_set(): raise
+    finally:
+        watchdog.cancel()
+
+    if expired.is_set():
+        raise CommandTimeout(str(cmd), timeout, scope, step)
+    return ret
+
+def _execute(cmd, timeout=None, **kwargs):
+    _debug("$ " + str(cmd))
+    if EXPECTED is not None:
+        _expect(cmd)
+        return (0, '', '')
+    _track_write(cmd)
+    # queries still run when staging, their answers decide what gets staged,
+    # unless the tool isn't on this machine (e.g. staging a Mac from Linux)
+    if ROOT_PATH and not (_is_readonly_cmd(cmd) and shutil.which(_program(cmd.argv))):
+        _stage(cmd)
+        return (0, '', '')
+
+    # foreground commands write straight to the terminal, so our output goes first
+    if 'stdout' in kwargs and kwargs['stdout'] is None:
+        _log_flush()
+    argv = cmd.argv[1:] if cmd.argv[:1] == ['sudo'] else cmd.argv
+    timeout, scope, step = _timeout_for(os.path.basename(argv[0]), timeout)
+    if _is_privileged(cmd, kwargs):
+        ret = _run_privileged(cmd, timeout, scope, step, **kwargs)
+    elif timeout is None:
+        ret = _plumbum(cmd).run(**kwargs)
+    else:
+        ret = _run_bounded(cmd, timeout, scope, step, **kwargs)
+    _journal_command(cmd)
+    return ret
+
+def _spawn(cmd, **kwargs):
+    _debug("$ " + str(cmd) + " &")
+    if EXPECTED is not None:
+        _expect(cmd)
+        return _NullProcess()
+    if ROOT_PATH:
+        _stage(cmd)
+        return _NullProcess()
+
+    proc = _plumbum(cmd).popen(**kwargs)
+    _journal_command(cmd)
+    return proc
+
+def _stage(cmd):
+    # nothing runs against a staging root: 'defaults' writes go straight into the
+    # plist files under it and everything else is only journaled
+    entry = _parse_defaults(cmd.argv) if cmd.stdin_cmd is None else None
+    if entry is None or not _stage_defaults(entry):
+        _journal_command(cmd)
+
+def _expect(cmd):
+    # while auditing, the 'defaults' writes are the settings we check, nothing runs
+    entry = _parse_defaults(cmd.argv) if cmd.stdin_cmd is None else None
+    if entry is not None and entry['verb'] in ('write', 'delete'):
+        entry['argv'] = cmd.argv
+        EXPECTED.append(('defaults', entry))
+
+def _save_journal(journal_path):
+    with open(journal_path, 'w') as f:
+        f.write(json.dumps({ 'op': 'context', 'user': SHELL_USER, 'user_path': USER_PATH }) + '\n')
+        for entry in JOURNAL:
+            f.write(json.dumps(entry) + '\n')
+    _grass("Recorded " + str(len(JOURNAL)) + " operations to '" + journal_path + "'")
+
+
+#########################
+# Privileged helper
+#
+# Instead of paying sudo (and its credential check) for every privileged
+# command, the first one starts this script once more as root, in helper mode,
+# and every 'sudo ...' command after that is sent to it over a pipe. Requests
+# are JSON lines, one request or a batch of them per line, and each result is
+# written back as soon as it's done. _run_all() sends a run of privileged
+# commands (e.g. the pmset and system defaults of a step) as one batch. It also
+# kills the process groups of the background tasks started with sudo, which we
+# can't signal ourselves. Foreground commands (they need the terminal) and
+# sudo's own flags (sudo -v) still go through sudo.
+
+PRIVILEGED_HELPER = None
+PRIVILEGED_LOCK = threading.Lock()
+
+def _privileged_run(request):
+    if 'kill' in request:
+        try:
+            os.killpg(request['kill'], request['signal'])
+        except ProcessLookupError:
+            pass
+        return { 'retcode': 0 }
+    proc = subprocess.Popen(request['argv'], cwd=request.get('cwd'), preexec_fn=os.setpgrp,
+                            stdin=subprocess.PIPE if request.get('input') is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
+    try:
+        stdout, stderr = proc.communicate(request.get('input'), timeout=request.get('timeout'))
+    except subprocess.TimeoutExpired:
+        _kill_group(proc)
+        proc.communicate()
+        return { 'timeout': True }
+    return { 'retcode': proc.returncode, 'stdout': stdout, 'stderr': stderr }
+
+def privileged_helper():
+    """Helper mode, running as root: executes the requests on stdin until it closes."""
+    for line in sys.stdin:
+        batch = json.loads(line)
+        for request in (batch if isinstance(batch, list) else [batch]):
+            try:
+                result = _privileged_run(request)
+            except Exception as e:
+                result = { 'error': repr(e) }
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+
+def _privileged_helper():
+    global PRIVILEGED_HELPER
+    if PRIVILEGED_HELPER is None or PRIVILEGED_HELPER.poll() is not None:
+        # the one password prompt of the run
+        _log_flush()
+        PRIVILEGED_HELPER = subprocess.Popen(['sudo', sys.executable, os.path.abspath(__file__), '--privileged-helper'],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        # closing its stdin is what stops it
+        atexit.register(PRIVILEGED_HELPER.stdin.close)
+    return PRIVILEGED_HELPER
+
+def _privileged(requests):
+    """Results of a batch of requests, run in order by the privileged helper."""
+    with PRIVILEGED_LOCK:
+        helper = _privileged_helper()
+        helper.stdin.write(json.dumps(requests) + '\n')
+        helper.stdin.flush()
+        results = []
+        for _ in requests:
+            line = helper.stdout.readline()
+            if not line:
+                raise RuntimeError("The privileged helper exited (sudo failed?)")
+            results.append(json.loads(line))
+    return results
+
+def _is_privileged(cmd, kwargs):
+    return cmd.argv[:1] == ['sudo'] and len(cmd.argv) > 1 and not cmd.argv[1].startswith('-') and set(kwargs) <= {'retcode'}
+
+def _privileged_request(cmd, timeout):
+    # whatever pipes into the command runs here, as us
+    stdin = _plumbum(cmd.stdin_cmd).run()[1] if cmd.stdin_cmd is not None else None
+    return { 'argv': cmd.argv[1:], 'input': stdin, 'cwd': os.getcwd(), 'timeout': timeout }
+
+def _privileged_result(cmd, result, timeout, scope, step, retcode):
+    if 'error' in result:
+        raise RuntimeError("'" + str(cmd) + "' failed in the privileged helper: " + result['error'])
+    if result.get('timeout'):
+        raise CommandTimeout(str(cmd), timeout, scope, step)
+    # same retcode checks plumbum does
+    expected = [ retcode ] if isinstance(retcode, int) else retcode
+    if expected is not None and result['retcode'] not in expected:
+        raise plumbum.commands.processes.ProcessExecutionError(cmd.argv, result['retcode'], result['stdout'], result['stderr'])
+    return (result['retcode'], result['stdout'], result['stderr'])
+
+def _run_privileged(cmd, timeout, scope, step, retcode=0):
+    if timeout is not None and timeout <= 0:
+        raise CommandTimeout(str(cmd), None, scope, step)
+    result, = _privileged([_privileged_request(cmd, timeout)])
+    return _privileged_result(cmd, result, timeout, scope, step, retcode)
+
+def _run_all(cmds, retcode=0):
+    """Runs the commands in order, in one round trip to the privileged helper when they all need it."""
+    if _simulated() or not all(_is_privileged(cmd, {}) for cmd in cmds):
+        return [ cmd.run(retcode=retcode) for cmd in cmds ]
+
+    # the helper runs the whole batch, the first failure is raised once it's done
+    limits = []
+    for cmd in cmds:
+        _debug("$ " + str(cmd))
+        _track_write(cmd)
+        timeout, scope, step = _timeout_for(os.path.basename(cmd.argv[1]))
+        if timeout is not None and timeout <= 0:
+            raise CommandTimeout(str(cmd), None, scope, step)
+        limits.append((timeout, scope, step))
+    results = _privileged([ _privileged_request(cmd, timeout) for cmd, (timeout, _, _) in zip(cmds, limits) ])
+    for cmd in cmds:
+        _journal_command(cmd)
+    return [ _privileged_result(cmd, result, timeout, scope, step, retcode) for cmd, result, (timeout, scope, step) in zip(cmds, results, limits) ]
+
+
+#########################
+# Preferences (defaults)
+#
+
+PLISTBUDDY = '/usr/libexec/PlistBuddy'
+PLISTBUDDY_TYPES = { bool: 'bool', int: 'integer', float: 'real', str: 'string' }
+
+# Parsed plists are cached by path and stat, so reading an unchanged file again
+# is free and a changed one is parsed again. The cached dicts are shared, so
+# callers copy them before making changes.
+PLIST_CACHE = collections.OrderedDict()
+PLIST_CACHE_BYTES = 32 * 1024 * 1024
+PLIST_CACHE_SIZE = 0
+PLIST_CACHE_STATS = collections.Counter()
+PLIST_CACHE_LOCK = threading.Lock()
+
+def _plist_cache_key(path):
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _plist_cache_put(key, plist):
+    global PLIST_CACHE_SIZE
+    # one entry per path, the version it replaces can't be read anymore
+    old = PLIST_CACHE.pop(key[0], None)
+    if old is not None:
+        PLIST_CACHE_SIZE -= old[0][2]
+    PLIST_CACHE[key[0]] = (key, plist)
+    PLIST_CACHE_SIZE += key[2]
+    # evict the least recently used until we're back under budget (sizes are the files' sizes)
+    while len(PLIST_CACHE) > 1 and PLIST_CACHE_SIZE > PLIST_CACHE_BYTES:
+        PLIST_CACHE_SIZE -= PLIST_CACHE.popitem(last=False)[1][0][2]
+        PLIST_CACHE_STATS['evictions'] += 1
+
+def _load_plist(path):
+    """Parsed contents of a plist file, None if it doesn't exist."""
+    try:
+        key = _plist_cache_key(path)
+    except FileNotFoundError:
+        return None
+
+    with PLIST_CACHE_LOCK:
+        cached = PLIST_CACHE.get(path)
+        if cached is not None and cached[0] == key:
+            PLIST_CACHE_STATS['hits'] += 1
+            PLIST_CACHE.move_to_end(path)
+            return cached[1]
+        PLIST_CACHE_STATS['misses'] += 1
+
+    with open(path, 'rb') as f:
+        plist = plistlib.load(f)
+    with PLIST_CACHE_LOCK:
+        _plist_cache_put(key, plist)
+    return plist
+
+def _dump_plist(path, plist, fmt=plistlib.FMT_BINARY):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        plistlib.dump(plist, f, fmt=fmt)
+    # what we just wrote is what the next read would parse
+    with PLIST_CACHE_LOCK:
+        _plist_cache_put(_plist_cache_key(path), plist)
+
+def _parse_defaults(argv):
+    """Splits a 'defaults' command line into its parts, None if it isn't one."""
+    sudo = (argv[:1] == ['sudo'])
+    argv = argv[1:] if sudo else argv
+    if not argv or os.path.basename(argv[0]) != 'defaults':
+        return None
+
+    args = argv[1:]
+    current_host = (args[:1] == ['-currentHost'])
+    if current_host: args = args[1:]
+    if len(args) < 2 or args[0] == '-host':
+        return None
+
+    domain = args[1]
+    if domain in ('-g', '-globalDomain', 'Apple Global Domain'):
+        domain = 'NSGlobalDomain'
+    entry = {
+        'sudo': sudo, 'current_host': current_host, 'verb': args[0], 'domain': domain,
+        'key': None, 'type': None, 'values': [],
+    }
+    rest = args[2:]
+    if rest:
+        entry['key'] = rest[0]
+        if len(rest) > 1 and rest[1].startswith('-'):
+            entry['type'] = rest[1][1:]
+            entry['values'] = rest[2:]
+        else:
+            entry['values'] = rest[1:]
+    return entry
+
+def _defaults_value(type_, values):
+    """Python value stored by 'defaults write', raises ValueError if we can't tell."""
+    if type_ in ('bool', 'boolean'):
+        value = values[0].lower()
+        if value in ('true', 'yes', '1'): return True
+        if value in ('false', 'no', '0'): return False
+        raise ValueError(value)
+    elif type_ in ('int', 'integer'):
+        return int(values[0])
+    elif type_ == 'float':
+        return float(values[0])
+    elif type_ in ('string', None):
+        # untyped values are parsed as plist, which we only handle for plain strings
+        if len(values) != 1 or (type_ is None and values[0][:1] in ('<', '(', '{', '"')):
+            raise ValueError(values)
+        return values[0]
+    elif type_ == 'array':
+        return list(values)
+    elif type_ == 'dict':
+        value, i = {}, 0
+        while i < len(values):
+            if i + 1 < len(values) and values[i+1].startswith('-'):
+                value[values[i]] = _defaults_value(values[i+1][1:], values[i+2:i+3])
+                i += 3
+            else:
+                value[values[i]] = _defaults_value('string', values[i+1:i+2])
+                i += 2
+        return value
+    raise ValueError(type_)
+
+def _defaults_plist_path(domain, sudo=False, current_host=False, user_path=None):
+    """Path of the plist file behind a domain, None if we can't tell (e.g. -currentHost)."""
+    if current_host:
+        return None
+    if domain.startswith('/'):
+        return domain if domain.endswith('.plist') else domain + '.plist'
+    prefs_path = os.path.join('/var/root' if sudo else (user_path or USER_PATH), 'Library/Preferences')
+    if domain == 'NSGlobalDomain':
+        return os.path.join(prefs_path, '.GlobalPreferences.plist')
+    return os.path.join(prefs_path, domain + '.plist')
+
+def _apply_defaults(plist, entry):
+    """Applies a 'defaults' write or delete entry to a plist dict, False if we can't tell what it does."""
+    if entry['key'] is None or entry['verb'] not in ('write', 'delete'):
+        return False
+
+    if entry['verb'] == 'delete':
+        plist.pop(entry['key'], None)
+        return True
+    try:
+        if entry['type'] == 'array-add':
+            plist[entry['key']] = plist.get(entry['key'], []) + [ _defaults_value('string', [v]) for v in entry['values'] ]
+        elif entry['type'] == 'dict-add':
+            plist[entry['key']] = dict(plist.get(entry['key'], {}), **_defaults_value('dict', entry['values']))
+        else:
+            plist[entry['key']] = _defaults_value(entry['type'], entry['values'])
+    except (ValueError, IndexError):
+        return False
+    return True
+
+def _stage_defaults(entry):
+    """Applies a 'defaults' entry to the plist file under the staging root, False if we can't."""
+    if entry['verb'] in ('read', 'read-type', 'export', 'domains', 'find'):
+        return True
+
+    path = _defaults_plist_path(entry['domain'], entry['sudo'], entry['current_host'])
+    if path is None or entry['key'] is None or entry['verb'] not in ('write', 'delete'):
+        return False
+
+    path = _rooted(path)
+    # writes only replace top level values, so a shallow copy keeps the cached dict intact
+    plist = dict(_load_plist(path) or {})
+    if not _apply_defaults(plist, entry):
+        return False
+
+    _dump_plist(path, plist)
+    return True
+
+def _merge_plist(live, managed, precedence='repo'):
+    """Deep merge of managed values into live ones, lists of dicts with a 'Guid' (profiles) are merged by it."""
+    if isinstance(live, dict) and isinstance(managed, dict):
+        merged = dict(live)
+        for key, value in managed.items():
+            merged[key] = _merge_plist(live[key], value, precedence) if key in live else value
+        return merged
+
+    if isinstance(live, list) and isinstance(managed, list) and all(isinstance(v, dict) and 'Guid' in v for v in live + managed):
+        merged = list(live)
+        index = { v['Guid']: i for i, v in enumerate(merged) }
+        for value in managed:
+            if value['Guid'] in index:
+                merged[index[value['Guid']]] = _merge_plist(merged[index[value['Guid']]], value, precedence)
+            else:
+                merged.append(value)
+        return merged
+
+    return managed if precedence == 'repo' else live
+
+def _plistbuddy_commands(entry):
+    """PlistBuddy commands equivalent to a 'defaults' entry, None if there is no safe translation."""
+    key = entry['key']
+    if key is None or ':' in key or '"' in key:
+        return None
+    keypath = ':"' + key + '"'
+
+    if entry['verb'] == 'delete':
+        return ['Delete ' + keypath]
+    if entry['verb'] != 'write':
+        return None
+
+    try:
+        value = _defaults_value(entry['type'], entry['values'])
+    except (ValueError, IndexError):
+        return None
+
+    def add(path, value):
+        if not isinstance(value, str) and type(value) in PLISTBUDDY_TYPES:
+            return ['Add ' + path + ' ' + PLISTBUDDY_TYPES[type(value)] + ' ' + str(value).lower()]
+        if isinstance(value, str) and '"' not in value and "'" not in value:
+            return ['Add ' + path + ' string "' + value + '"']
+        if isinstance(value, list):
+            return ['Add ' + path + ' array'] + sum([ add(path + ':', v) for v in value ], [])
+        if isinstance(value, dict):
+            return ['Add ' + path + ' dict'] + sum([ add(path + ':"' + k + '"', v) for k, v in value.items() ], [])
+        raise ValueError(value)
+
+    try:
+        return ['Delete ' + keypath] + add(keypath, value)
+    except ValueError:
+        return None
+
+
+#########################
+# Journal compiler
+#
+# Turns a journal recorded with --record into a standalone shell script that
+# replays it without python. Back to back 'defaults' writes are coalesced into
+# one PlistBuddy call per plist file, which is written out before the next
+# command that isn't one of them (e.g. the 'killall Dock' that reloads it).
+# Everything else is replayed as recorded, from the directory it ran in.
+
+def compile_journal(journal_path, script_path):
+    with open(journal_path, 'r') as f:
+        entries = [ json.loads(l) for l in f if l.strip() ]
+    # plists are where the recorded user's are, not ours
+    context = next((e for e in entries if e['op'] == 'context'), {})
+    user_path = context.get('user_path')
+
+    # first pass: find the plist writes we can translate, only if the whole file can be coalesced
+    plist_sudo = {}
+    uncoalesced = set()
+    for entry in entries:
+        if entry['op'] != 'run': continue
+        defaults_entry = _parse_defaults(entry['argv'])
+        if defaults_entry is None: continue
+
+        path = _defaults_plist_path(defaults_entry['domain'], defaults_entry['sudo'], defaults_entry['current_host'], user_path)
+        commands = _plistbuddy_commands(defaults_entry)
+        if path is None: continue
+        if commands is None:
+            uncoalesced.add(path)
+            continue
+        plist_sudo[path] = plist_sudo.get(path, False) or defaults_entry['sudo'] or path.startswith('/Library/')
+        entry['plist'] = (path, commands)
+    coalesced = set(plist_sudo) - uncoalesced
+
+    lines = [
+        '#!/bin/sh',
+        '# Generated by dotfyles.py from ' + os.path.basename(journal_path) + ' on ' + datetime.datetime.now().isoformat(),
+        '',
+    ]
+    if any(plist_sudo.values()) or any(e.get('argv', [''])[0] == 'sudo' for e in entries):
+        lines += ['sudo -v', '']
+
+    # PlistBuddy writes the files directly, so cfprefsd has to drop its cached
+    # copies before anything else reads those preferences
+    stale_cfprefsd = set()
+    def flush_cfprefsd():
+        flush = [ ('sudo ' if sudo else '') + 'killall cfprefsd' for sudo in sorted(stale_cfprefsd) ]
+        stale_cfprefsd.clear()
+        return flush
+
+    # plist writes waiting for the next command that isn't one of them
+    pending = collections.OrderedDict()
+    def flush_plists():
+        flush = []
+        for path, commands in pending.items():
+            plistbuddy = ([ 'sudo' ] if plist_sudo[path] else []) + [ PLISTBUDDY ]
+            for command in commands:
+                plistbuddy += ['-c', command]
+            flush.append(' '.join(shlex.quote(a) for a in plistbuddy + [path]) + ' >/dev/null 2>&1')
+            stale_cfprefsd.add(plist_sudo[path])
+        pending.clear()
+        return flush
+
+    previous = None
+    cwd = None
+    for entry in entries:
+        op = entry['op']
+        if op == 'run':
+            path, commands = entry.get('plist', (None, None))
+            if path in coalesced:
+                pending.setdefault(path, []).extend(commands)
+                continue
+            line = ' '.join(shlex.quote(a) for a in entry['argv'])
+        elif op == 'shell':
+            line = entry['cmdline']
+        elif op == 'symlink':
+            line = 'mkdir -p ' + shlex.quote(os.path.dirname(entry['dst'])) + ' && ln -sfn ' + shlex.quote(entry['src']) + ' ' + shlex.quote(entry['dst'])
+        elif op == 'touch':
+            line = 'touch ' + shlex.quote(entry['path'])
+        elif op == 'copy':
+            line = 'cp -f ' + shlex.quote(entry['src']) + ' ' + shlex.quote(entry['dst'])
+        elif op == 'sync':
+            line = 'mkdir -p ' + shlex.quote(entry['dst']) + ' && rsync -a --delete ' + shlex.quote(entry['src'] + '/') + ' ' + shlex.quote(entry['dst'] + '/')
+        elif op == 'download':
+            line = 'curl -fsSL --create-dirs -o ' + shlex.quote(entry['path']) + ' ' + shlex.quote(entry['url'])
+        elif op == 'write':
+            data = '\n'.join(entry['data'][n:n+76] for n in range(0, len(entry['data']), 76))
+            line = 'base64 --decode > ' + shlex.quote(entry['path']) + " <<'DOTFYLES_EOF'\n" + data + '\nDOTFYLES_EOF'
+        else:
+            continue
+
+        flush = flush_plists()
+        lines += flush + flush_cfprefsd()
+        if entry.get('cwd', cwd) != cwd:
+            cwd = entry['cwd']
+            lines.append('cd ' + shlex.quote(cwd))
+            previous = None
+        # recorded runs repeat a lot of commands back to back (e.g. 'killall' of the same app)
+        if line != previous or flush:
+            lines.append(line)
+        previous = line
+    lines += flush_plists()
+    lines += flush_cfprefsd()
+
+    with open(script_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(script_path, 0o755)
+
+    operations = [ e for e in entries if e['op'] != 'context' ]
+    _grass("Compiled " + str(len(operations)) + " operations into '" + script_path + "' (" + str(len(coalesced)) + " plist files coalesced)")
+    return script_path
+
+
+#########################
+# Background lookups
+#
+# Read-only lookups that don't depend on the user's answers. They are all
+# started at once when we boot, so they are ready by the time the user is done
+# answering the personal_info() prompts.
+
+BREW_TOOLS = ['brew', 'mas', 'dockutil', 'duti']
+PREFETCH = {}
+PREFETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+def _lookup_git_config(key):
+    ret = local['git']['config', '--global', key].run(retcode=None)
+    return ret[1].rstrip('\n')
+
+def _github_public_info(github_user):
+    return requests.get('https://api.github.com/users/' + github_user, timeout=10).json()
+
+def _lookup_github_info():
+    # public info of the github user we already have configured
+    github_user = _lookup_git_config('github.user')
+    if not github_user:
+        return {}
+    return _github_public_info(github_user)
+
+def _lookup_computer_name():
+    # reading doesn't need sudo, which also avoids a password prompt from a background thread
+    return local['scutil']['--get', 'ComputerName'].run()[1].rstrip("\n\r")
+
+def _lookup_tools():
+    return { tool: (shutil.which(tool) or shutil.which(tool, path='/usr/local/bin')) for tool in BREW_TOOLS }
+
+def _lookup_mas_account():
+    mas = _prefetched('tools', {}).get('mas')
+    if mas is None:
+        return None
+    return local[mas]['account'].run(retcode=None)
+
+def _lookup_brew_inventory():
+    brew = local.get('brew','/usr/local/bin/brew')
+    return set(brew['list', '-1'].run()[1].split())
+
+def _lookup_brew_bundle_check():
+    brew = local.get('brew','/usr/local/bin/brew')
+    return brew['bundle', 'check', '--file=' + _abspath('.Brewfile')].run(retcode=None)
+
+PREFETCH_LOOKUPS = collections.OrderedDict([
+    ('tools', (_lookup_tools,)),
+    ('github_user', (_lookup_git_config, 'github.user')),
+    ('user_name', (_lookup_git_config, 'user.name')),
+    ('user_email', (_lookup_git_config, 'user.email')),
+    ('github_info', (_lookup_github_info,)),
+    ('computer_name', (_lookup_computer_name,)),
+    ('mas_account', (_lookup_mas_account,)),
+    ('brew_inventory', (_lookup_brew_inventory,)),
+    ('brew_bundle_check', (_lookup_brew_bundle_check,)),
+])
+
+def _prefetch(name):
+    if name not in PREFETCH:
+        func, *args = PREFETCH_LOOKUPS[name]
+        PREFETCH[name] = PREFETCH_POOL.submit(func, *args)
+    return PREFETCH[name]
+
+def _prefetched(name, default=None):
+    # lookups that were not started yet (e.g. with --method) run on demand
+    try:
+        return _prefetch(name).result()
+    except Exception:
+        return default
+
+def start_prefetch():
+    for name in PREFETCH_LOOKUPS:
+        _prefetch(name)
+
+
+#########################
+# Installed applications
+#
+# App steps say which bundle they configure with @_needs_app and are skipped
+# right away when it isn't installed, instead of opening (or waiting on) an app
+# that is never going to show up. The app folders are scanned once per run, and
+# again after brew installs the casks, into an index by bundle id.
+
+APPLICATION_DIRS = ['/Applications', '/Applications/Utilities', '~/Applications']
+APP_INDEX = None
+
+def _scan_apps():
+    index = {}
+    for apps_dir in APPLICATION_DIRS:
+        # the apps of the live machine, even when staging (see _needs_app)
+        apps_dir = os.path.join(USER_PATH, apps_dir[2:]) if apps_dir.startswith('~') else apps_dir
+        try:
+            entries = [ e for e in os.scandir(apps_dir) if e.name.endswith('.app') ]
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                with open(os.path.join(entry.path, 'Contents/Info.plist'), 'rb') as f:
+                    bundle_id = plistlib.load(f).get('CFBundleIdentifier')
+            except Exception:
+                continue
+            # the first folder wins, like LaunchServices prefers /Applications
+            if bundle_id and bundle_id not in index:
+                index[bundle_id] = entry.path
+    return index
+
+def _app_path(bundle_id, default=None):
+    global APP_INDEX
+    if APP_INDEX is None:
+        APP_INDEX = _scan_apps()
+        _debug("Indexed " + str(len(APP_INDEX)) + " installed applications")
+    return APP_INDEX.get(bundle_id, default)
+
+def _needs_app(*bundle_ids):
+    # any of the ids will do, apps change theirs between versions (e.g. Alfred 3 and 4)
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(*args, **kwargs):
+            # a staging root gets configured for apps that are only installed later
+            if not ROOT_PATH and all(_app_path(bundle_id) is None for bundle_id in bundle_ids):
+                _info("Skipping '" + step.__name__ + "', '" + "' or '".join(bundle_ids) + "' isn't installed")
+                return None
+            return step(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+#########################
+# Background tasks
+#
+# Long commands that nothing after them depends on (software updates, the
+# Spotlight reindex, brew cleanup) run detached with their output going to a
+# log file, while the steps go on. The final summary waits for them.
+
+BACKGROUND_LOGS_PATH = '~/Library/Logs/dotfyles'
+BACKGROUND_TASKS = []
+
+def _background(name, cmd):
+    if _simulated():
+        proc, log_path = cmd.popen(), None
+    else:
+        log_path = os.path.join(_abspath(BACKGROUND_LOGS_PATH), name + '.log')
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        # asking for the password has to happen now, it can't from the background
+        if cmd.argv[:1] == ['sudo']:
+            local['sudo']['-v'] & FG
+        with open(log_path, 'w') as log:
+            # own process group, so ctrl-c on us doesn't reach it and we can kill all of it
+            proc = cmd.popen(stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setpgrp)
+
+    BACKGROUND_TASKS.append({ 'name': name, 'proc': proc, 'log': log_path, 'started': time.time(), 'sudo': cmd.argv[:1] == ['sudo'] })
+    _info("Running '" + name + "' in the background" + ((", output in '" + log_path + "'") if log_path else ''))
+    return proc
+
+def wait_background():
+    if not BACKGROUND_TASKS:
+        return []
+
+    _grass("Waiting for the background tasks")
+    failed = []
+    for task in BACKGROUND_TASKS:
+        # bounded by what is left of the run's --deadline
+        timeout = _timeout_for(None)[0]
+        killed = True
+        try:
+            code = task['proc'].wait(timeout=None if timeout is None else max(timeout, 0))
+        except subprocess.TimeoutExpired:
+            # the sudo ones can only be killed through the privileged helper
+            killed = _kill_group(task['proc'], privileged=task['sudo'])
+            code = None
+
+        elapsed = str(round(time.time() - task['started'])) + "s"
+        log = (", see '" + task['log'] + "'") if task['log'] else ''
+        if code == 0:
+            _info("'" + task['name'] + "' finished after " + elapsed)
+        elif not killed:
+            _warn("'" + task['name'] + "' is still running after " + elapsed + ", the run is out of time and it couldn't be killed" + log)
+            failed.append(task['name'])
+        elif code is None:
+            _warn("'" + task['name'] + "' was killed after " + elapsed + ", the run is out of time" + log)
+            failed.append(task['name'])
+        else:
+            _warn("'" + task['name'] + "' failed with exit code " + str(code) + log)
+            failed.append(task['name'])
+    BACKGROUND_TASKS.clear()
+    _ok()
+    return failed
+
+
+#########################
+# Drift audit
+#
+# --verify runs the steps with EXPECTED set, so instead of changing anything
+# they only note the settings, symlinks and files they manage. Those are then
+# checked against the machine with one read per preferences domain (all
+# domains in parallel) and one lstat per symlink.
+
+def collect_expected(steps):
+    global EXPECTED
+    EXPECTED, errors = [], []
+    try:
+        for step in steps:
+            # the steps still log what they would do, which is just noise here
+            with _log_group(discard=True):
+                try:
+                    step()
+                except Exception as e:
+                    errors.append({ 'step': step.__name__, 'error': repr(e) })
+        expected = EXPECTED
+    finally:
+        EXPECTED = None
+    return expected, errors
+
+def _read_domain(domain, sudo, current_host):
+    """Current contents of a preferences domain, None if it doesn't exist."""
+    path = _defaults_plist_path(domain, sudo, current_host)
+    # user domains are exported through cfprefsd, whose cache can be newer than the file
+    if ROOT_PATH or sudo or domain.startswith('/'):
+        if path is None:
+            raise ValueError("can't locate the plist file of '" + domain + "'")
+        return _load_plist(_rooted(path))
+
+    defaults = local['defaults']['-currentHost'] if current_host else local['defaults']
+    ret = defaults['export', domain, '-'].run(retcode=None)
+    if ret[0] != 0:
+        return None
+    return plistlib.loads(ret[1].encode('utf-8'))
+
+def _audit_domain(domain_key, entries):
+    domain, sudo, current_host = domain_key
+
+    # replay the writes in order to know what each key should end up as
+    expected, unknown, keys = {}, set(), []
+    for entry in entries:
+        if entry['key'] not in keys: keys.append(entry['key'])
+        if _apply_defaults(expected, entry):
+            unknown.discard(entry['key'])
+        else:
+            unknown.add(entry['key'])
+
+    def result(key, status, actual=None, error=None):
+        return {
+            'kind': 'defaults', 'domain': domain, 'key': key, 'current_host': current_host,
+            'status': status, 'expected': expected.get(key), 'actual': actual, 'error': error,
+        }
+
+    try:
+        actual = _read_domain(domain, sudo, current_host) or {}
+    except Exception as e:
+        return [ result(key, 'unverifiable', error=repr(e)) for key in keys ]
+
+    results = []
+    for key in keys:
+        if key in unknown:
+            results.append(result(key, 'unverifiable', actual.get(key), "can't tell what the write stores"))
+        elif key not in actual:
+            results.append(result(key, 'ok' if key not in expected else 'missing'))
+        elif key not in expected or actual[key] != expected[key]:
+            results.append(result(key, 'drift', actual[key]))
+        else:
+            results.append(result(key, 'ok', actual[key]))
+    return results
+
+def _audit_symlink(src, dst):
+    result = { 'kind': 'symlink', 'path': dst, 'expected': src, 'actual': None, 'status': 'ok' }
+    try:
+        st = os.lstat(dst)
+    except FileNotFoundError:
+        result['status'] = 'missing'
+        return result
+
+    if not stat.S_ISLNK(st.st_mode):
+        result['status'], result['actual'] = 'drift', 'not a symlink'
+    else:
+        result['actual'] = os.readlink(dst)
+        if result['actual'] != src: result['status'] = 'drift'
+    return result
+
+def _audit_file(path, data=None, src=None):
+    result = { 'kind': 'file', 'path': path, 'expected': src, 'actual': None, 'status': 'ok' }
+    try:
+        if src is not None:
+            if not filecmp.cmp(src, path, shallow=False): result['status'] = 'drift'
+        elif isinstance(data, bytes) and data.startswith(b'bplist'):
+            # binary plists written by other versions of plistlib (or by the app) differ in bytes, not in contents
+            actual = _load_plist(path)
+            if actual is None: result['status'] = 'missing'
+            elif actual != plistlib.loads(data): result['status'] = 'drift'
+        elif data is not None:
+            with open(path, 'rb' if isinstance(data, bytes) else 'r') as f:
+                if f.read() != data: result['status'] = 'drift'
+        else:
+            os.lstat(path)
+    except FileNotFoundError:
+        result['status'] = 'missing'
+    except OSError as e:
+        result['status'], result['actual'] = 'unverifiable', repr(e)
+    return result
+
+def _group_expected(expected):
+    # the last word on each symlink/file is the one that counts
+    domains = collections.OrderedDict()
+    symlinks = collections.OrderedDict()
+    files = collections.OrderedDict()
+    for kind, *item in expected:
+        if kind == 'defaults':
+            entry = item[0]
+            domains.setdefault((entry['domain'], entry['sudo'], entry['current_host']), []).append(entry)
+        elif kind == 'symlink':
+            symlinks[item[1]] = item[0]
+        elif kind == 'file':
+            files[item[0]] = { 'data': item[1] }
+        elif kind == 'copy':
+            files[item[1]] = { 'src': item[0] }
+    return domains, symlinks, files
+
+def audit(expected):
+    domains, symlinks, files = _group_expected(expected)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        reads = [ pool.submit(_audit_domain, key, entries) for key, entries in domains.items() ]
+        results = [ r for read in reads for r in read.result() ]
+    results += [ _audit_symlink(src, dst) for dst, src in symlinks.items() ]
+    results += [ _audit_file(path, **kwargs) for path, kwargs in files.items() ]
+    return results
+
+def collect_managed():
+    return collect_expected([git, shell, conf_osx, conf_apps])
+
+def _report_result(r):
+    what = (r['domain'] + ' ' + r['key']) if r['kind'] == 'defaults' else r['path']
+    if r['status'] in ('drift', 'missing'):
+        _warn("[" + r['status'] + "] " + what + ": expected " + repr(r['expected']) + ", found " + repr(r['actual']))
+    elif r['status'] == 'unverifiable':
+        _info("[unverifiable] " + what + ((": " + r['error']) if r.get('error') else ''))
+
+def verify(as_json=False):
+    started = time.time()
+    expected, errors = collect_managed()
+    results = audit(expected)
+
+    summary = collections.Counter(r['status'] for r in results)
+    drifted = summary['drift'] + summary['missing']
+    report = {
+        'clean': not drifted and not errors,
+        'checked': len(results),
+        'summary': { s: summary[s] for s in ('ok', 'drift', 'missing', 'unverifiable') },
+        'results': results,
+        'errors': errors,
+        'seconds': round(time.time() - started, 3),
+        'plist_cache': dict(PLIST_CACHE_STATS),
+    }
+
+    if as_json:
+        _safe_print(json.dumps(report, indent=2, default=str), kind='report', level=LOG_QUIET)
+    else:
+        _snek("Verifying managed settings")
+        for r in results:
+            _report_result(r)
+        for e in errors:
+            _warn("Could not evaluate '" + e['step'] + "': " + e['error'])
+        _grass("Checked " + str(report['checked']) + " settings in " + str(report['seconds']) + "s: "
+               + ', '.join(str(n) + ' ' + s for s, n in report['summary'].items()))
+        _debug("plist cache: " + str(PLIST_CACHE_STATS['hits']) + " hits, " + str(PLIST_CACHE_STATS['misses']) + " misses")
+
+    # 0 clean, 1 drifted, 2 some step couldn't be evaluated
+    return 1 if drifted else (2 if errors else 0)
+
+
+#########################
+# Drift watcher
+#
+# --watch keeps auditing after the first pass, but only re-checks what lives in
+# files that changed since (compared by inode, mtime and size). In between it
+# sleeps on kqueue where there is one (macOS), so an idle watcher costs nothing,
+# and otherwise polls the stats.
+
+WATCH_INTERVAL = 5
+
+def _stat_key(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _domain_watch_path(domain, sudo, current_host):
+    if current_host:
+        # -currentHost plists are named after the hardware UUID, so we watch their whole dir
+        return _rooted(os.path.join(USER_PATH, 'Library/Preferences/ByHost'))
+    return _rooted(_defaults_plist_path(domain, sudo, current_host))
+
+def _watch_checks(expected):
+    """Maps each watched path to the (audit, fix) pairs of what we manage in it."""
+    domains, symlinks, files = _group_expected(expected)
+    checks = collections.OrderedDict()
+
+    def fix_domain(entries, drifted):
+        keys = { r['key'] for r in drifted }
+        for entry in entries:
+            if entry['key'] in keys:
+                local[entry['argv'][0]][entry['argv'][1:]].run(retcode=None)
+
+    def fix_file(path, data=None, src=None):
+        if src is not None: _copy_file(src, path)
+        elif data is not None: _write_file(path, data)
+        else: _touch(path)
+
+    for key, entries in domains.items():
+        checks.setdefault(_domain_watch_path(*key), []).append((
+            lambda key=key, entries=entries: _audit_domain(key, entries),
+            lambda drifted, entries=entries: fix_domain(entries, drifted),
+        ))
+    for dst, src in symlinks.items():
+        checks.setdefault(dst, []).append((
+            lambda dst=dst, src=src: [ _audit_symlink(src, dst) ],
+            lambda drifted, dst=dst, src=src: _create_symlink(src, dst),
+        ))
+    for path, kwargs in files.items():
+        checks.setdefault(path, []).append((
+            lambda path=path, kwargs=kwargs: [ _audit_file(path, **kwargs) ],
+            lambda drifted, path=path, kwargs=kwargs: fix_file(path, **kwargs),
+        ))
+    return checks
+
+def _change_waiter(paths):
+    """Function that blocks until one of the paths' dirs changes, or the timeout runs out."""
+    if not hasattr(select, 'kqueue'):
+        return time.sleep
+
+    dirs = { os.path.dirname(p) for p in paths } | { p for p in paths if os.path.isdir(p) }
+    fds = []
+    for d in dirs:
+        try:
+            fds.append(os.open(d, os.O_RDONLY))
+        except OSError:
+            pass
+    kq = select.kqueue()
+    flags = select.KQ_NOTE_WRITE | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME | select.KQ_NOTE_ATTRIB
+    kq.control([ select.kevent(fd, filter=select.KQ_FILTER_VNODE, flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR, fflags=flags) for fd in fds ], 0)
+
+    def wait(timeout):
+        if kq.control(None, max(len(fds), 1), timeout):
+            # give whoever is writing (usually cfprefsd) a moment to finish
+            time.sleep(0.5)
+    return wait
+
+def watch(fix=False, interval=WATCH_INTERVAL):
+    expected, errors = collect_managed()
+    for e in errors:
+        _warn("Could not evaluate '" + e['step'] + "': " + e['error'])
+    checks = _watch_checks(expected)
+    wait = _change_waiter(list(checks))
+
+    _snek("Watching " + str(len(checks)) + " files for drift" + (", re-applying what drifts" if fix else ""))
+    stats = {}
+    try:
+        while True:
+            changed = [ path for path in checks if path not in stats or _stat_key(path) != stats[path] ]
+            for path in changed:
+                stats[path] = _stat_key(path)
+                for check, fix_check in checks[path]:
+                    drifted = [ r for r in check() if r['status'] in ('drift', 'missing') ]
+                    if not drifted:
+                        continue
+                    with _log_group():
+                        for r in drifted: _report_result(r)
+                        if fix:
+                            fix_check(drifted)
+                            _ok("Re-applied " + str(len(drifted)) + " settings in '" + path + "'")
+            wait(interval)
+    except KeyboardInterrupt:
+        _snek("Stopped watching.")
+
+#########################
+# Shell history
+#
+# --history compacts ~/.zsh_history and merges in the histories of other
+# machines: entries from all files are merged by timestamp and only the latest
+# run of each command is kept. Files are streamed off mmaps in two passes (the
+# first only remembers a short hash per command), so it runs in about the same
+# memory for a multi-hundred MB history. We work on bytes all along, zsh
+# metafies non-ASCII bytes and that would not survive a decode.
+
+HISTORY_PATH = '~/.zsh_history'
+# extended history, ': <start>:<elapsed>;<command>'
+HISTORY_ENTRY = re.compile(rb': *(\d+):\d+;')
+
+def _history_entries(path):
+    """(timestamp, command, entry) for each entry of a zsh history file."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mm:
+            if hasattr(mm, 'madvise'):
+                # read once front to back, the kernel can drop pages behind us
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            size = len(mm)
+            start = pos = timestamp = 0
+            while start < size:
+                end = mm.find(b'\n', pos)
+                end = size if end == -1 else end
+                # zsh writes the newlines inside a command as '\\\n'
+                if end < size and end > start and mm[end - 1] == ord('\\'):
+                    pos = end + 1
+                    continue
+                entry = mm[start:end]
+                start = pos = end + 1
+                if not entry.strip():
+                    continue
+                match = HISTORY_ENTRY.match(entry)
+                if match is not None:
+                    timestamp = int(match.group(1))
+                # plain (non extended) entries keep the timestamp of the one before
+                yield timestamp, entry[match.end():] if match else entry, entry
+
+def _merged_history(paths):
+    # every file is appended in time order, so a k-way merge keeps it streaming
+    return heapq.merge(*[ _history_entries(p) for p in paths ], key=lambda e: e[0])
+
+@contextlib.contextmanager
+def _history_lock(path, timeout=10):
+    # the same lock file zsh takes before it rewrites the history
+    lock = path + '.LOCK'
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() > deadline:
+                raise TimeoutError("'" + lock + "' is held by another shell")
+            time.sleep(0.1)
+    try:
+        os.write(fd, str(os.getpid()).encode('ascii'))
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock)
+
+def history(sources=()):
+    path = _abspath(HISTORY_PATH)
+    # rewrite where the symlink points, it lives in the repo
+    real_path = os.path.realpath(path)
+    missing = [ s for s in sources if not os.path.isfile(s) ]
+    for s in missing:
+        _warn("No history at '" + s + "', skipping it")
+    paths = [ p for p in [ real_path ] + [ os.path.abspath(s) for s in sources if s not in missing ] if os.path.isfile(p) ]
+    if not paths:
+        _warn("No history to compact at '" + path + "'")
+        return 1
+
+    _snek("Compacting '" + path + "'" + (" with " + str(len(paths) - 1) + " other histories" if len(paths) > 1 else ""))
+    started = time.time()
+    digest = lambda command: hashlib.blake2b(command, digest_size=8).digest()
+    try:
+        with _history_lock(path):
+            # first pass: where each command last shows up
+            latest = {}
+            for i, (_, command, _) in enumerate(_merged_history(paths)):
+                latest[digest(command)] = i
+            total = i + 1 if latest else 0
+
+            # second pass: keep only those
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(real_path), prefix='.zsh_history.')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    for i, (_, command, entry) in enumerate(_merged_history(paths)):
+                        if latest[digest(command)] == i:
+                            out.write(entry + b'\n')
+                    out.flush()
+                    os.fsync(out.fileno())
+                shutil.copymode(real_path, tmp_path)
+                os.replace(tmp_path, real_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+    except TimeoutError as e:
+        _warn(str(e) + ", try again later")
+        return 1
+
+    _grass("Kept " + str(len(latest)) + " of " + str(total) + " entries in " + str(round(time.time() - started, 2)) + "s ("
+           + str(os.path.getsize(real_path) // 1024) + " KB)")
+    return 0
+
+
+#########################
+# Changed domains
+#
+# The apps that read a preferences domain only need a restart when the run
+# actually changed it. The first write to each of those domains snapshots it,
+# and teardown compares the snapshots with what's there now. Staged runs can't
+# compare anything, so whatever they write counts as changed.
+
+# domain -> processes that only pick up its changes when restarted
+RESTART_PROCESSES = collections.OrderedDict([
+    ('NSGlobalDomain', ['Finder', 'Dock', 'SystemUIServer']),
+    ('com.apple.dock', ['Dock']),
+    ('com.apple.dashboard', ['Dock']),
+    ('com.apple.finder', ['Finder']),
+    ('com.apple.desktopservices', ['Finder']),
+    ('com.apple.systemuiserver', ['SystemUIServer']),
+    ('com.apple.menuextra.clock', ['SystemUIServer']),
+    ('com.apple.menuextra.battery', ['SystemUIServer']),
+    ('com.apple.screencapture', ['SystemUIServer']),
+    ('com.apple.ActivityMonitor', ['Activity Monitor']),
+    ('com.apple.iCal', ['Calendar', 'iCal']),
+    ('org.m0k.transmission', ['Transmission']),
+    ('cx.c3.theunarchiver', ['The Unarchiver']),
+    ('com.macpaw.site.theunarchiver', ['The Unarchiver']),
+])
+DOMAIN_SNAPSHOTS = collections.OrderedDict()
+UNKNOWN_DOMAIN = object()
+
+def _written_domain(argv):
+    """(domain, sudo, current_host) a command writes to, None if it doesn't write preferences."""
+    entry = _parse_defaults(argv)
+    if entry is not None:
+        if entry['verb'] in ('write', 'delete', 'import', 'rename'):
+            return (entry['domain'], entry['sudo'], entry['current_host'])
+        return None
+    program = os.path.basename((argv[1:] if argv[:1] == ['sudo'] else argv)[0])
+    if program == 'dockutil' and '--list' not in argv:
+        return ('com.apple.dock', False, False)
+    return None
+
+def _track_write(cmd):
+    key = _written_domain(cmd.argv)
+    if key is None or key[0] not in RESTART_PROCESSES or key in DOMAIN_SNAPSHOTS:
+        return
+    try:
+        DOMAIN_SNAPSHOTS[key] = UNKNOWN_DOMAIN if ROOT_PATH else _read_domain(*key)
+    except Exception:
+        DOMAIN_SNAPSHOTS[key] = UNKNOWN_DOMAIN
+
+def _changed_domains():
+    changed = []
+    for key, before in DOMAIN_SNAPSHOTS.items():
+        try:
+            after = UNKNOWN_DOMAIN if before is UNKNOWN_DOMAIN else _read_domain(*key)
+        except Exception:
+            after = UNKNOWN_DOMAIN
+        if after is UNKNOWN_DOMAIN or after != before:
+            changed.append(key[0])
+    return changed
+
+
+#########################
+# Step budgets
+#
+# @_budgeted gives a step a time budget, on top of the per-command timeouts
+# and the --deadline of the whole run. When a command of the step times out,
+# on_timeout decides what happens: 'fail' fails the step, 'skip' keeps what it
+# did so far and 'retry' runs the step again. Any step a command times out in
+# fails (without a budget too), run_steps then goes on with the steps that
+# don't need it. Running out of the whole run's deadline always stops the run.
+
+def _budgeted(seconds, on_timeout='fail', retries=1):
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(*args, **kwargs):
+            attempts = retries + 1 if on_timeout == 'retry' else 1
+            for attempt in range(1, attempts + 1):
+                STEP_DEADLINES.append((time.time() + seconds, step.__name__))
+                try:
+                    return step(*args, **kwargs)
+                except CommandTimeout as e:
+                    # other steps' budgets and the run's deadline are not ours to handle
+                    if on_timeout == 'fail' or e.scope == 'run' or (e.scope == 'step' and e.step != step.__name__):
+                        raise
+                    _warn(str(e))
+                    if on_timeout == 'skip':
+                        _warn("Skipping the rest of '" + step.__name__ + "'")
+                        return None
+                    if attempt == attempts:
+                        raise
+                    _warn("Retrying '" + step.__name__ + "' (" + str(attempt + 1) + "/" + str(attempts) + ")")
+                finally:
+                    STEP_DEADLINES.pop()
+        return wrapper
+    return decorator
+
+
+#########################
+# Step fingerprints
+#
+# Steps that only depend on a few input files declare them with
+# @_fingerprinted. After a successful run we store a hash of those files, the
+# step's parameters and its code, and the next run skips the step while the
+# hash stays the same (unless --force). The code is the step's bytecode with
+# its literals, the public helpers it calls (e.g. shell__plugins) and the
+# constants they read (e.g. ZSH_PLUGINS_BUNDLE_VERSION). A step that raises, or returns False
+# because some of it failed, keeps its old hash so the next run tries again.
+# Recording, baking and auditing always run every step.
+
+FINGERPRINTS_PATH = '~/.cache/dotfyles/fingerprints.json'
+FORCE = False
+
+def _hash_code(h, func, seen):
+    func = inspect.unwrap(func)
+    if func in seen:
+        return
+    seen.add(func)
+
+    def code(c):
+        h.update(c.co_code)
+        h.update(repr(c.co_names).encode('utf-8'))
+        for const in c.co_consts:
+            if isinstance(const, types.CodeType):
+                code(const)
+            else:
+                # frozensets of strings don't repr in the same order on every run
+                h.update(repr(sorted(const) if isinstance(const, frozenset) else const).encode('utf-8'))
+        for name in c.co_names:
+            value = func.__globals__.get(name)
+            if isinstance(value, types.FunctionType) and not name.startswith('_') and value.__globals__ is func.__globals__:
+                _hash_code(h, value, seen)
+            elif name.isupper() and isinstance(value, (bool, int, float, str, tuple)):
+                h.update((name + '=' + repr(value)).encode('utf-8'))
+    code(func.__code__)
+
+def _fingerprint(step, files, params):
+    h = hashlib.sha256()
+    _hash_code(h, step, set())
+    h.update(repr(params).encode('utf-8'))
+    for f in files:
+        path = _abspath(f)
+        h.update(path.encode('utf-8'))
+        try:
+            with open(path, 'rb') as fd:
+                h.update(hashlib.sha256(fd.read()).digest())
+        except (FileNotFoundError, IsADirectoryError):
+            h.update(b'missing')
+    return h.hexdigest()
+
+def _load_fingerprints():
+    try:
+        with open(_abspath(FINGERPRINTS_PATH), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_fingerprint(name, fingerprint):
+    fingerprints = _load_fingerprints()
+    fingerprints[name] = { 'fingerprint': fingerprint, 'time': time.time() }
+    path = _abspath(FINGERPRINTS_PATH)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+
+def _fingerprinted(*files, params=lambda: [], max_age=None):
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(*args, **kwargs):
+            if EXPECTED is not None or JOURNAL is not None:
+                return step(*args, **kwargs)
+
+            stored = _load_fingerprints().get(step.__name__)
+            fresh = stored is not None and (max_age is None or time.time() - stored['time'] < max_age)
+            if not FORCE and fresh and stored['fingerprint'] == _fingerprint(step, files, params()):
+                _info("Skipping '" + step.__name__ + "', its inputs didn't change since the last run (use --force to run it)")
+                return None
+
+            ret = step(*args, **kwargs)
+            if ret is False:
+                return ret
+            # hashed after the run, since some steps rewrite their own inputs (e.g. .gitignore)
+            _save_fingerprint(step.__name__, _fingerprint(step, files, params()))
+            return ret
+        return wrapper
+    return decorator
+
+
+#########################
+# Step profiling
+#
+# --profile writes a cProfile of every step to <dir>/<step>.prof, and
+# --trace-memory the lines that allocated the most while it ran. The wall
+# time a step took but didn't spend on our CPU went to the commands it ran.
+# The hotspots of the whole run are printed at the end. Without them the steps
+# run as they are.
+
+PROFILE_PATH = None
+TRACE_MEMORY = False
+PROFILE_TOP = 15
+STEP_PROFILES = []
+
+def _profiled(name, step):
+    def run(*args, **kwargs):
+        os.makedirs(PROFILE_PATH, exist_ok=True)
+        profile = cProfile.Profile()
+        if TRACE_MEMORY:
+            tracemalloc.start()
+        started, cpu_started = time.time(), time.process_time()
+        profile.enable()
+        try:
+            return step(*args, **kwargs)
+        finally:
+            profile.disable()
+            stats = { 'step': name, 'seconds': time.time() - started, 'cpu': time.process_time() - cpu_started }
+            profile.dump_stats(os.path.join(PROFILE_PATH, name + '.prof'))
+            if TRACE_MEMORY:
+                snapshot = tracemalloc.take_snapshot()
+                stats['peak'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                with open(os.path.join(PROFILE_PATH, name + '.allocations.txt'), 'w') as f:
+                    for stat in snapshot.statistics('lineno')[:PROFILE_TOP * 2]:
+                        f.write(str(stat) + '\n')
+            STEP_PROFILES.append(stats)
+    return run
+
+def profile_report():
+    if not STEP_PROFILES:
+        return
+    _snek("Profiled " + str(len(STEP_PROFILES)) + " steps into '" + PROFILE_PATH + "'")
+    for stats in sorted(STEP_PROFILES, key=lambda s: -s['seconds']):
+        _info(stats['step'].ljust(28) + str(round(stats['seconds'], 2)).rjust(8) + "s, " + str(round(stats['cpu'], 2)).rjust(6) + "s in python"
+              + ((", peak " + str(stats['peak'] // 1024) + " KB") if 'peak' in stats else ''))
+
+    out = io.StringIO()
+    profiles = [ os.path.join(PROFILE_PATH, s['step'] + '.prof') for s in STEP_PROFILES ]
+    pstats.Stats(*profiles, stream=out).sort_stats('tottime').print_stats(PROFILE_TOP)
+    _grass("Hotspots")
+    # the header says where the stats came from, the table is what matters
+    _safe_print(out.getvalue().split('\n\n', 1)[-1].strip('\n'))
+
+
 #########################
 # Step functions
 #
@@ -185,6 +2178,8 @@ def _check_output_zsh(cmd):
 PIP_DEPENDENCIES = ['plumbum', 'requests']
 SHELL_USER = os.getenv('SUDO_USER') if os.getenv('SUDO_USER') else getpass.getuser()
 USER_PATH = os.path.expanduser('~'+SHELL_USER)
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = ''
 GITHUB_USR = ''
 GITHUB_PWD = ''
 APPLE_ID_EMAIL = ''
@@ -192,30 +2187,13 @@ USER_NAME = ''
 USER_EMAIL = ''
 MAC_NAME = ''
 SIP_ENABLED = None
-
-
-def ensure_sudo():
-    su = sudo[local['su']]
-    chmod = sudo[local['chmod']]
-
-    # recall this script with sudo
-    if os.geteuid() != 0:
-        _warn(SNEK + " needs sudo to run!")
-
-        # make sure the file can be written to
-        chmod['+w', '/etc/profile'].run()
-        # read its contents
-        with open('/etc/profile', 'r') as f:
-            USER_PATH = os.path.join(os.path.expanduser('~'+SHELL_USER), '.profile')
-            to_write = "source " + USER_PATH
-            if to_write not in f.read():
-                os.system("echo '" + to_write + "' | sudo tee -a /etc/profile")
-
-        subprocess.call(['sudo', sys.executable, *sys.argv])
-        exit()
+ANSWERS = None
 
 
 def install_pip_packages():
+    # the usual case, listing every installed distribution takes longer than most picked steps
+    if all(importlib.util.find_spec(p) is not None for p in PIP_DEPENDENCIES):
+        return []
     packages = get_installed_distributions()
     packages = [ p.project_name for p in packages ]
     needed_packages = list(set(PIP_DEPENDENCIES) - set(packages))
@@ -246,12 +2224,21 @@ def personal_info():
 
     _grass("Getting your Github info")
 
-    existing_github_user = git['config', '--global', 'github.user'].run(retcode=None)[1].rstrip('\n')
-    GITHUB_USR = _question("Github username", default=existing_github_user)
+    existing_github_user = _prefetched('github_user', '')
+    GITHUB_USR = _question("Github username", default=existing_github_user, key='github_user')
 
     github_info = []
-    if GITHUB_USR != existing_github_user:
-        GITHUB_PWD = _question("Github '" + GITHUB_USR + "' password", pwd=True)
+    if GITHUB_USR != existing_github_user and ANSWERS is not None and 'github_password' not in ANSWERS:
+        # unattended runs without a password only get the public info, instead
+        # of failing the login with an empty one
+        try:
+            github_info = _github_public_info(GITHUB_USR)
+        except Exception:
+            github_info = {}
+        existing_name = github_info.get('name') or ''
+        existing_email = github_info.get('email') or ''
+    elif GITHUB_USR != existing_github_user:
+        GITHUB_PWD = _question("Github '" + GITHUB_USR + "' password", pwd=True, key='github_password')
         session = requests.Session()
         session.auth = (GITHUB_USR, GITHUB_PWD)
         github_info = session.get('https://api.github.com/users/'+GITHUB_USR).json()
@@ -262,11 +2249,13 @@ def personal_info():
         existing_email = github_info['email']
         github_clientid = github_info['id']
     else:
-        existing_name = git['config', '--global', 'user.name'].run(retcode=None)[1].rstrip('\n')
-        existing_email = git['config', '--global', 'user.email'].run(retcode=None)[1].rstrip('\n')
+        # fallback to the public github info when git has nothing configured
+        github_info = _prefetched('github_info', {})
+        existing_name = _prefetched('user_name', '') or github_info.get('name') or ''
+        existing_email = _prefetched('user_email', '') or github_info.get('email') or ''
 
-    USER_EMAIL = _question("Set email to", default=existing_email)
-    USER_NAME = _question("Set user full name to", default=existing_name)
+    USER_EMAIL = _question("Set email to", default=existing_email, key='email')
+    USER_NAME = _question("Set user full name to", default=existing_name, key='name')
     _ok()
 
 
@@ -276,16 +2265,16 @@ def personal_info():
     if mas is None:
         _warn("Cannot install 'mas'! Skipping Apple ID setup.")
     else:
-        mas_has_account = mas['account'].run(retcode=None)
+        mas_has_account = _prefetched('mas_account') or mas['account'].run(retcode=None)
         if mas_has_account[0] == 1:
-            APPLE_ID_EMAIL = _question("Please enter your Apple ID email", default=USER_EMAIL)
+            APPLE_ID_EMAIL = _question("Please enter your Apple ID email", default=USER_EMAIL, key='apple_id')
             mas['signin', APPLE_ID_EMAIL] & FG
 
     _ok()
 
     _grass("Set computer name")
-    MAC_NAME = scutil['--get', 'ComputerName'].run()[1].rstrip("\n\r")
-    MAC_NAME = _question("Please enter your Mac's name", default=MAC_NAME)
+    MAC_NAME = _prefetched('computer_name') or scutil['--get', 'ComputerName'].run()[1].rstrip("\n\r")
+    MAC_NAME = _question("Please enter your Mac's name", default=MAC_NAME, key='mac_name')
     _info("Set computer name to: " + MAC_NAME)
     scutil['--set', 'ComputerName', MAC_NAME].run()
     scutil['--set', 'HostName', MAC_NAME].run()
@@ -313,12 +2302,14 @@ def git():
     _grass("Setting [github.token] parameter")
     gitconfig_private = _abspath('.gitconfig.private')
     has_token = git['config', '-f', gitconfig_private, 'github.token'].run(retcode=None)
-    if (has_token[0] == 1) or (not has_token[1]):
+    # auditing only checks the links, there's nobody to ask for a token
+    if EXPECTED is None and ((has_token[0] == 1) or (not has_token[1])):
         _info("Opening Github tokens website")
         openapp["https://github.com/settings/tokens"] & BG
-        github_token = _question("Please input your github command line token: ")
-        _info("Adding github token to your .gitconfig.private file")
-        git['config', '-f', gitconfig_private, 'github.token', github_token] & FG
+        github_token = _question("Please input your github command line token: ", key='github_token')
+        if github_token:
+            _info("Adding github token to your .gitconfig.private file")
+            git['config', '-f', gitconfig_private, 'github.token', github_token] & FG
     _ok()
 
     update_gitignore()
@@ -330,6 +2321,8 @@ def git():
     _ok()
 
 
+# the remote lists change too, so we refresh them at least once a week
+@_fingerprinted('.gitignore', max_age=7*24*60*60)
 def update_gitignore():
     GITIGNORE_URLS = [
         'https://raw.githubusercontent.com/github/gitignore/master/Global/macOS.gitignore',
@@ -344,28 +2337,33 @@ def update_gitignore():
         'https://raw.githubusercontent.com/github/gitignore/master/Gradle.gitignore',
     ]
     GITIGNORE_SEP_LINE = '#######################\n#######################'
+    if EXPECTED is not None:
+        # it's built from whatever the remote lists are today, there's nothing to check it against
+        return
 
 
     _grass("Updating global .gitignore")
 
     # get our personal part of .gitignore
-    f = open(_abspath('.gitignore'),'r')
+    f = open(_repo_input('.gitignore'),'r')
     own_gitignore = f.read().split(GITIGNORE_SEP_LINE,1)[0]
     f.close()
 
-    # we ignore the rest and build again from the urls
+    # we ignore the rest and build again from the urls, fetched all at once
     remote_gitignore = ''
     remote_gitignore_values = set()
-    for url in GITIGNORE_URLS:
+    for url, path in zip(GITIGNORE_URLS, _download_files([ (url, None) for url in GITIGNORE_URLS ], fresh=True)):
         header = '\n\n\n' \
                  '#######################\n' \
                  '# ' + url + ' \n' \
                  '#\n\n'
 
-        remote_gitignore += header + requests.get(url).text
+        with open(path, 'r') as f:
+            text = f.read()
+        remote_gitignore += header + text
 
         # add content of the file
-        for l in requests.get(url).text.splitlines():
+        for l in text.splitlines():
             if l and (not l.startswith('#')):
                 remote_gitignore_values.add(l)
 
@@ -376,13 +2374,15 @@ def update_gitignore():
         own_gitignore = own_gitignore.replace(dup + '\n', '')
 
     merged_files = ''.join([own_gitignore, GITIGNORE_SEP_LINE, remote_gitignore])
-    with open(_abspath('.gitignore'), 'w') as tmp_gitignore:
-        tmp_gitignore.write(merged_files)
+    _write_file(_repo_output('.gitignore'), merged_files)
 
     _ok()
 
 
+@_budgeted(2*60*60, on_timeout='retry')
+@_fingerprinted('.Brewfile', '.loginitems', params=lambda: [USER_PATH])
 def brew():
+    global APP_INDEX
     brew = local['brew']
     readlink = local['/usr/bin/readlink']
 
@@ -396,19 +2396,86 @@ def brew():
     brewfile = '.Brewfile'
     _symlink_to_home(brewfile)
 
-    brew_bundle_check = brew['bundle', 'check', '--file='+brewfile].run(retcode=None)
+    brew_bundle_check = _prefetched('brew_bundle_check') or brew['bundle', 'check', '--file='+brewfile].run(retcode=None)
+    installed = True
     if brew_bundle_check[0] == 1:
-        brew['bundle', 'install', '--file='+brewfile].run(retcode=None)
+        installed = brew['bundle', 'install', '--file='+brewfile].run(retcode=None)[0] == 0
+        # the casks just installed weren't there when the apps were indexed
+        APP_INDEX = None
+        if not installed:
+            _warn("Some of the '" + brewfile + "' bundle failed to install, it will be tried again on the next run")
 
     _ok()
 
     _grass("Brew post-installation settings")
-    # TODO: handle login items
-    # _download_file('https://raw.githubusercontent.com/jfloff/loginitems/master/loginitems-ls', loginitemsls_path)
-
+    brew__login_items()
     _ok()
+    return installed
+
+
+LOGIN_ITEMS_PATH = '.loginitems'
+LOGIN_ITEMS_SCRIPT = 'loginitems-ls'
+# the paths of the login items dotfyles added, only those are ever removed
+LOGIN_ITEMS_STATE_PATH = '~/.cache/dotfyles/loginitems.json'
+
+def _parse_login_items(text):
+    """(name, path, hidden) for each 'name;path;hidden' line, as loginitems-ls prints them."""
+    items = []
+    for line in text.splitlines():
+        fields = line.strip().split(';')
+        if len(fields) == 3:
+            items.append((fields[0], fields[1], fields[2].strip() == 'true'))
+    return items
+
+def _applescript_string(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _login_items_script(current, wanted, managed=()):
+    """AppleScript (inside a System Events tell) that turns the current login items into the wanted ones."""
+    current_keys = { (path, hidden) for _, path, hidden in current }
+    wanted_keys = { (path, hidden) for _, path, hidden in wanted }
+    # the ones the user added themselves are left alone, only ours are removed
+    # (and any wanted one whose 'hidden' changed, it's added back)
+    ours = set(managed) | { path for _, path, _ in wanted }
+    lines = [ 'delete login item ' + _applescript_string(name) for name, path, hidden in current
+              if path in ours and (path, hidden) not in wanted_keys ]
+    lines += [ 'make login item at end with properties {path:' + _applescript_string(path) + ', hidden:' + ('true' if hidden else 'false') + '}'
+               for _, path, hidden in wanted if (path, hidden) not in current_keys ]
+    return lines
+
+def _load_managed_login_items():
+    try:
+        with open(_abspath(LOGIN_ITEMS_STATE_PATH), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return []
+
+def _osascript(args):
+    return local['osascript'][args].run()[1]
+
+def brew__login_items(run_script=_osascript):
+    _info("Syncing login items with '" + LOGIN_ITEMS_PATH + "'")
+    with open(os.path.join(REPO_PATH, LOGIN_ITEMS_PATH), 'r') as f:
+        wanted = [ (name, _replace_user_path(path, USER_PATH), hidden) for name, path, hidden in _parse_login_items(f.read()) ]
+
+    # one script lists them all and one adds and removes what differs
+    current = _parse_login_items(run_script([os.path.join(REPO_PATH, LOGIN_ITEMS_SCRIPT)]))
+    managed = _load_managed_login_items()
+    lines = _login_items_script(current, wanted, managed)
+    if lines:
+        script = [ 'tell application "System Events"' ] + lines + [ 'end tell' ]
+        run_script([ a for line in script for a in ('-e', line) ])
+        _info("Changed " + str(len(lines)) + " login items")
+    else:
+        _info("Login items are already in sync")
+
+    wanted_paths = sorted({ path for _, path, _ in wanted })
+    if wanted_paths != managed:
+        _write_file(LOGIN_ITEMS_STATE_PATH, json.dumps(wanted_paths, indent=2))
+    return lines
 
 
+@_fingerprinted('.gitmodules', '.tmux/.tmux.conf', '.tmux.conf.local', '.zshrc', '.profile', params=lambda: [SHELL_USER, USER_PATH, LAZY_INITS])
 def shell():
     chsh = sudo[local['chsh']]
     which = local['which']
@@ -419,7 +2486,8 @@ def shell():
 
     _grass("Setting up ZSH")
 
-    which_zsh = which['zsh'].run()[1].rstrip('\n')
+    # the one macOS ships, when this machine (e.g. staging a root) has none
+    which_zsh = which['zsh'].run(retcode=None)[1].rstrip('\n') or '/bin/zsh'
     chsh['-s', which_zsh, SHELL_USER].run()
     chmod['-R', '755', '/usr/local/share'].run()
 
@@ -435,14 +2503,17 @@ def shell():
     _create_symlink('.points', '~/.config/wdx/points')
     _ok()
 
+    plugins_bundled = shell__plugins()
+    shell__lazy_init()
+
     _grass("Silencing macOS login MOTD")
-    touch[_abspath('~/.hushlogin')].run()
+    _touch('~/.hushlogin')
     _ok()
 
     # https://github.com/gpakosz/.tmux
     _grass("Setting tmux")
     git['submodule', 'update', '--init', '--recursive']
-    shutil.copy('.tmux/.tmux.conf', '.')
+    _copy_file('.tmux/.tmux.conf', _repo_output('.tmux.conf'))
     _symlink_to_home('.tmux.conf')
     _symlink_to_home('.tmux.conf.local')
     _ok()
@@ -450,6 +2521,273 @@ def shell():
     _grass("Setting .ssh dir")
     _symlink_to_home('.ssh')
     _ok()
+    return plugins_bundled
+
+
+ZSH_PLUGINS_CACHE_PATH = '~/.cache/dotfyles/zsh-plugins'
+ZSH_PLUGINS_BUNDLE_PATH = '~/.zsh_plugins.zsh'
+# bumped when what the bundle sets changes, so existing bundles get rebuilt
+ZSH_PLUGINS_BUNDLE_VERSION = 2
+ZPLUG_DECLARATION = re.compile(r'^\s*zplug\s+["\']([^"\']+)["\']\s*(.*)$')
+ZPLUG_TAG = re.compile(r'([\w-]+):\s*["\']?([^,"\'\s]+)')
+# what zplug sources from a plugin without 'use:', the first pattern that matches wins
+ZPLUG_DEFAULT_USE = ['*.plugin.zsh', '*.zsh-theme', 'init.zsh', '*.zsh', '*.sh']
+
+def _zplug_plugins(zshrc_path):
+    with open(zshrc_path, 'r') as f:
+        text = f.read().replace('\\\n', ' ')
+
+    plugins = []
+    for line in text.splitlines():
+        match = ZPLUG_DECLARATION.match(line)
+        if match is None:
+            continue
+        tags = dict(ZPLUG_TAG.findall(match.group(2)))
+        plugins.append({
+            'name': match.group(1), 'from': tags.get('from', 'github'), 'use': tags.get('use'),
+            'as': tags.get('as', 'plugin'), 'defer': int(tags.get('defer', 0)),
+        })
+    return plugins
+
+def _zplug_repo(plugin):
+    # (dir under the cache, git url) with the same layout zplug uses for its repos
+    if plugin['from'] == 'oh-my-zsh':
+        return 'robbyrussell/oh-my-zsh', 'https://github.com/robbyrussell/oh-my-zsh.git'
+    if plugin['from'] == 'gist':
+        return plugin['name'], 'https://gist.github.com/' + plugin['name'].split('/')[-1] + '.git'
+    return plugin['name'], 'https://github.com/' + plugin['name'] + '.git'
+
+def _zplug_files(plugin, repo_path):
+    """(plugin dir, files to source) the way zplug would load them."""
+    plugin_dir = repo_path
+    if plugin['from'] == 'oh-my-zsh':
+        plugin_dir = os.path.join(repo_path, plugin['name'])
+        # 'lib/grep' is a file, 'plugins/git' a dir with a git.plugin.zsh
+        if os.path.isfile(plugin_dir + '.zsh'):
+            return os.path.dirname(plugin_dir), [ plugin_dir + '.zsh' ]
+
+    for pattern in ([ plugin['use'] ] if plugin['use'] else ZPLUG_DEFAULT_USE):
+        files = sorted(glob.glob(os.path.join(plugin_dir, pattern)))
+        if files:
+            return plugin_dir, files
+    return plugin_dir, []
+
+def shell__plugins():
+    git = local['git']
+    zsh = local['zsh']
+
+
+    _grass("Building the zsh plugin bundle")
+
+    plugins = _zplug_plugins(os.path.join(REPO_PATH, '.zshrc'))
+    declarations = hashlib.sha256(json.dumps([ZSH_PLUGINS_BUNDLE_VERSION, plugins], sort_keys=True).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(_abspath(ZSH_PLUGINS_CACHE_PATH), 'repos')
+    bundle_path = _abspath(ZSH_PLUGINS_BUNDLE_PATH)
+    header = '# Generated by dotfyles.py from the zplug declarations in .zshrc (' + declarations + ')'
+
+    # the plugins are fetched once, after that only the declarations decide if we rebuild
+    repos = collections.OrderedDict(_zplug_repo(p) for p in plugins)
+    missing = [ (name, url) for name, url in repos.items() if not os.path.isdir(os.path.join(cache_path, name)) ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda r: git['clone', '--quiet', '--depth', '1', r[1], os.path.join(cache_path, r[0])].run(retcode=None), missing))
+    missing = [ name for name in repos if not os.path.isdir(os.path.join(cache_path, name)) ]
+    if missing:
+        _warn("Couldn't fetch " + str(len(missing)) + " of the zsh plugins (e.g. '" + missing[0] + "'). Keeping zplug for now.")
+        return False
+
+    if os.path.exists(bundle_path) and EXPECTED is None:
+        with open(bundle_path, 'r') as f:
+            if f.readline().rstrip('\n') == header:
+                _info("Plugins didn't change, bundle is up to date")
+                _ok()
+                return True
+
+    fpath, sources, commands = [], [], []
+    for plugin in sorted(plugins, key=lambda p: p['defer']):
+        plugin_dir, files = _zplug_files(plugin, os.path.join(cache_path, _zplug_repo(plugin)[0]))
+        fpath.append(plugin_dir)
+        if plugin['as'] == 'command':
+            commands.append(plugin_dir)
+        else:
+            sources += [ (plugin['defer'], f) for f in files ]
+
+    # like zplug, deferred plugins (defer:2 and up) load after compinit
+    lines = [
+        header,
+        '[[ -d ' + shlex.quote(cache_path) + ' ]] || return 1',
+        'typeset -g ZSH_PLUGIN_REPOS=' + shlex.quote(cache_path) + ' ZSH_PLUGINS_LOADED=1',
+        'fpath=(' + ' '.join(shlex.quote(d) for d in fpath) + ' $fpath)',
+    ]
+    if commands:
+        lines.append('path=(' + ' '.join(shlex.quote(d) for d in commands) + ' $path)')
+    lines += [ 'source ' + shlex.quote(f) for defer, f in sources if defer < 2 ]
+    lines.append('autoload -Uz compinit && compinit -C')
+    lines += [ 'source ' + shlex.quote(f) for defer, f in sources if defer >= 2 ]
+    _write_file(bundle_path, '\n'.join(lines) + '\n')
+
+    # zsh picks up the .zwc next to a file when it's newer
+    _info("Compiling " + str(len(sources) + 1) + " files")
+    zsh[['-c', 'for f in "$@"; do zcompile "$f"; done', 'zsh', bundle_path] + [ f for _, f in sources ]].run(retcode=None)
+    _ok()
+    return True
+
+
+PROFILE_LAZY_PATH = '~/.profile.lazy'
+# tools whose init is too slow to run in every shell: the init to eval, and the
+# commands that need it. Their stubs run the init on first use, then get out of the
+# way. A wrapper function named like the tool (jenv() in .profile) calls the loader
+# itself, and is kept when the init defines its own function
+LAZY_INITS = collections.OrderedDict([
+    ('jenv', { 'init': 'jenv init -', 'commands': ['java', 'javac', 'jar', 'jshell', 'mvn', 'gradle'] }),
+])
+
+def shell__lazy_init():
+    _grass("Generating lazy init stubs")
+
+    # .profile must source the stubs instead of running the inits itself
+    with open(os.path.join(REPO_PATH, '.profile'), 'r') as f:
+        profile = f.read()
+    for tool, lazy in LAZY_INITS.items():
+        if re.search(r'eval\s+"\$\(\s*' + re.escape(lazy['init']), profile):
+            _warn(".profile still runs '" + lazy['init'] + "' on every shell, the stub is pointless until it's removed")
+    if PROFILE_LAZY_PATH not in profile:
+        _warn(".profile doesn't source '" + PROFILE_LAZY_PATH + "', the stubs won't be used")
+
+    lines = ['# Generated by dotfyles.py from LAZY_INITS, edit it there']
+    for tool, lazy in LAZY_INITS.items():
+        loader = '_dotfyles_lazy_' + re.sub(r'\W', '_', tool)
+        lines += [
+            '',
+            'if command -v ' + shlex.quote(tool) + ' > /dev/null 2>&1; then',
+            '  ' + loader + '() {',
+            '    unset -f ' + ' '.join(lazy['commands'] + [loader]),
+            # a wrapper of our own (jenv() in .profile) stays, and gets the init's function as _dotfyles_init_<tool>
+            '    local wrapper="$(typeset -f ' + shlex.quote(tool) + ' 2> /dev/null)"',
+            '    eval "$(command ' + lazy['init'] + ')"',
+            '    if [ -n "$wrapper" ]; then',
+            '      eval "_dotfyles_init_$(typeset -f ' + shlex.quote(tool) + ')"',
+            '      eval "$wrapper"',
+            '    fi',
+            '  }',
+        ]
+        # 'function' so a same-named alias (mvn) doesn't break re-sourcing
+        lines += [ '  function ' + c + ' { ' + loader + '; ' + c + ' "$@"; }' for c in lazy['commands'] ]
+        lines.append('fi')
+    _write_file(PROFILE_LAZY_PATH, '\n'.join(lines) + '\n')
+    _ok()
+
+
+#########################
+# Shell benchmark
+#
+# --bench-shell N times N interactive shells (`zsh -i -c exit`) started with a
+# bare environment, so our own env doesn't skew them, and then traces one more
+# with timestamps in PS4 to see where the time goes: each traced line is charged
+# the time until the next one, summed per sourced file and per plugin repo.
+
+BENCH_SHELL_PATH = '/usr/local/bin:/usr/bin:/bin:/usr/sbin:/sbin'
+# +<epoch with microseconds>\t<file being sourced>\t
+BENCH_SHELL_PS4 = '+%D{%s.%6.}\t%x\t'
+
+def _bench_shell_env():
+    return {
+        'HOME': USER_PATH, 'USER': SHELL_USER, 'LOGNAME': SHELL_USER, 'SHELL': shutil.which('zsh') or 'zsh',
+        'PATH': BENCH_SHELL_PATH, 'TERM': os.environ.get('TERM', 'xterm-256color'), 'LANG': os.environ.get('LANG', 'en_US.UTF-8'),
+    }
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+def _plugin_of(path):
+    # zplug and our bundle keep plugins as <...>/repos/<owner>/<repo>, oh-my-zsh ones a level deeper
+    parts = path.split('/repos/', 1)
+    if len(parts) == 1:
+        return 'zplug' if '/zplug/' in path else None
+    name = parts[1].split('/')
+    if name[:2] == ['robbyrussell', 'oh-my-zsh'] and len(name) > 3:
+        return '/'.join(name[2:4]).replace('.zsh', '')
+    return '/'.join(name[:2])
+
+def _trace_shell(env):
+    """Seconds spent per sourced file, from one xtraced `zsh -i -c exit`."""
+    # a throwaway ZDOTDIR turns xtrace on before the user's own startup files run
+    with tempfile.TemporaryDirectory(prefix='dotfyles-bench-') as zdotdir:
+        with open(os.path.join(zdotdir, '.zshenv'), 'w') as f:
+            f.write("PS4=$'" + BENCH_SHELL_PS4.replace('\t', '\\t') + "'\nsetopt xtrace\n"
+                    '[[ -r $HOME/.zshenv ]] && source $HOME/.zshenv\n')
+        with open(os.path.join(zdotdir, '.zshrc'), 'w') as f:
+            f.write('[[ -r $HOME/.zshrc ]] && source $HOME/.zshrc\n')
+        trace = subprocess.run([env['SHELL'], '-i', '-c', 'exit'], env=dict(env, ZDOTDIR=zdotdir), cwd=USER_PATH,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr
+
+    files = collections.Counter()
+    previous = None
+    for line in trace.decode('utf-8', 'replace').splitlines():
+        # multi-line commands continue without the PS4 prefix
+        fields = line.split('\t', 2)
+        if not line.startswith('+') or len(fields) < 3:
+            continue
+        try:
+            stamp = float(fields[0].lstrip('+'))
+        except ValueError:
+            # zsh too old for %6. in %D{}, no timestamps
+            return None
+        if previous is not None:
+            files[previous[1]] += stamp - previous[0]
+        previous = (stamp, fields[1])
+    return files
+
+def bench_shell(runs, as_json=False):
+    if shutil.which('zsh') is None:
+        _warn("zsh isn't installed, nothing to benchmark.")
+        return 1
+
+    env = _bench_shell_env()
+    # not through local, the runs shouldn't be journaled or staged, and plumbum's overhead would count
+    def startup():
+        started = time.perf_counter()
+        subprocess.run([env['SHELL'], '-i', '-c', 'exit'], env=env, cwd=USER_PATH,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - started
+
+    # first run warms the fs cache and writes .zcompdump, it isn't representative
+    startup()
+    times = [ startup() for _ in range(runs) ]
+    files = _trace_shell(env)
+
+    plugins = collections.Counter()
+    for path, seconds in (files or {}).items():
+        plugin = _plugin_of(path)
+        if plugin is not None:
+            plugins[plugin] += seconds
+
+    ms = lambda seconds: round(seconds * 1000, 2)
+    report = {
+        'runs': runs,
+        'ms': { 'p50': ms(_percentile(times, 50)), 'p95': ms(_percentile(times, 95)), 'max': ms(max(times)) },
+        'samples': [ ms(t) for t in times ],
+        'files': None if files is None else collections.OrderedDict((p, ms(s)) for p, s in files.most_common()),
+        'plugins': collections.OrderedDict((p, ms(s)) for p, s in plugins.most_common()),
+    }
+
+    if as_json:
+        _safe_print(json.dumps(report, indent=2), kind='report', level=LOG_QUIET)
+        return 0
+
+    _snek("Shell startup over " + str(runs) + " runs: p50 " + str(report['ms']['p50']) + "ms, p95 "
+          + str(report['ms']['p95']) + "ms, max " + str(report['ms']['max']) + "ms")
+    if files is None:
+        _warn("This zsh can't timestamp its trace, no per file breakdown.")
+        return 0
+    _grass("Slowest files (one traced run)")
+    for path, seconds in files.most_common(10):
+        _info(str(ms(seconds)).rjust(9) + "ms  " + path.replace(USER_PATH, '~', 1))
+    if plugins:
+        _grass("Slowest plugins")
+        for plugin, seconds in plugins.most_common(10):
+            _info(str(ms(seconds)).rjust(9) + "ms  " + plugin)
+    return 0
 
 
 def check_sip(double_check=False):
@@ -463,7 +2801,7 @@ def check_sip(double_check=False):
     if SIP_ENABLED: _warn("SIP is enabled!")
 
     if SIP_ENABLED and double_check:
-        if not _question("Do you want to continue with " + SNEK + " ? Some settings might be skipped.", yN=True):
+        if not _question("Do you want to continue with " + SNEK + " ? Some settings might be skipped.", yN=True, key='sip_continue'):
             _warn("Restart your Mac. Hold down Command-R until you see an Apple icon and a progress bar. Go to Utilities > Terminal. Type `csrutil disable` and then restart.")
             _snek("Cya soon ... Hisss.")
             exit()
@@ -471,6 +2809,7 @@ def check_sip(double_check=False):
     return SIP_ENABLED
 
 
+@_budgeted(3*60*60, on_timeout='skip')
 def update_osx():
     global USER_EMAIL, APPLE_ID_EMAIL
     softwareupdate = sudo[local['softwareupdate']]
@@ -485,7 +2824,7 @@ def update_osx():
     _info("Check for software updates daily, not just once per week")
     defaults['write', '/Library/Preferences/com.apple.SoftwareUpdate', 'ScheduleFrequency', '-int', '1'].run()
     _info("Check for software updates now")
-    softwareupdate['-i', '-a'].run()
+    _background('softwareupdate', softwareupdate['-i', '-a'])
     if mas is not None: mas['upgrade'].run()
     _ok()
 
@@ -522,6 +2861,7 @@ def conf_osx__general():
     _ok()
 
 
+@_fingerprinted('.macos_dock', params=lambda: [USER_PATH])
 def conf_osx__dock():
     defaults = local['defaults']
     dockutil = _local_with_brew_check('dockutil')
@@ -584,6 +2924,7 @@ def conf_osx__dock():
     _info("Setup docker icons")
     openapp['/Applications/Docker.app']
     # tries to read file, if it doesnt exist we do nothing
+    added = True
     if dock_settings is None:
         _warn("No macOS dock settings found at '~/.macos_dock'. It might be your first setup. If its not, either run with 'dockutil' or wait for crontab task.")
     else:
@@ -605,7 +2946,9 @@ def conf_osx__dock():
                 # add no-restart on every command except the last
                 params = ['--add', app_path, '--section', app_section]
                 if i < row_count: params.append('--no-restart')
-                dockutil[params].run(retcode=None)
+                if dockutil[params].run(retcode=None)[0] != 0:
+                    _warn("Couldn't add '" + app_path + "' to the Dock")
+                    added = False
 
     # _info("Reset dock to fix icons")
     # sudo[find['/private/var/folders/', '-name', 'com.apple.iconservices', '-exec', 'rm', '-rf', '\{\}', '\\']].run()
@@ -615,6 +2958,7 @@ def conf_osx__dock():
     # defaults write com.apple.dock ResetLaunchPad -bool true;
 
     _ok()
+    return added
 
 
 def conf_osx__mission_control():
@@ -712,27 +3056,27 @@ def conf_osx__sec():
     #running "Never go into computer sleep mode"
     #sudo systemsetup -setcomputersleep Off > /dev/null;ok
 
-    _info("Set standby to 24h")
-    pmset['-a', 'standbydelay', '86400'].run()
-
-    _info("Reveal IP, hostname, OS, etc. when clicking clock in login window")
-    sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'AdminHostInfo', 'HostName']].run()
-
     _info("Require password immediately after sleep or screen saver begins")
     defaults['write', 'com.apple.screensaver', 'askForPassword', '-int', '1'].run()
     defaults['write', 'com.apple.screensaver', 'askForPasswordDelay', '-int', '0'].run()
 
+    _info("Set standby to 24h")
+    _info("Reveal IP, hostname, OS, etc. when clicking clock in login window")
     _info("Enable application from everywhere")
-    spctl['--master-disable'].run()
-
     _info("Enable firewall ... better safe than sorry")
-    socketfilterfw["--setglobalstate", "on"].run()
-    sudo[defaults['write', '/Library/Preferences/com.apple.alf', 'globalstate', '-int', '1']].run()
+    _run_all([
+        pmset['-a', 'standbydelay', '86400'],
+        sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'AdminHostInfo', 'HostName']],
+        spctl['--master-disable'],
+        socketfilterfw["--setglobalstate", "on"],
+        sudo[defaults['write', '/Library/Preferences/com.apple.alf', 'globalstate', '-int', '1']],
+    ])
 
 
     _ok()
 
 
+@_budgeted(30*60, on_timeout='skip')
 def conf_osx__spotlight():
     defaults = local['defaults']
     killall = local['killall']
@@ -748,7 +3092,7 @@ def conf_osx__spotlight():
     # Make sure indexing is enabled for the main volume
     mdutil['-i', 'on'].run(retcode=None)
     # rebuild index
-    mdutil['-E', '/'].run(retcode=None)
+    _background('spotlight-reindex', mdutil['-E', '/'])
 
     _info("Change Spotlight indexing")
     SPOTLIGHT_INDEX_SETTINGS = {
@@ -918,13 +3262,13 @@ def conf_osx__login():
     _grass("Set login settings")
 
     _info("Disable guest account form login window")
-    sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'GuestEnabled', '-bool', 'false']].run()
-
     _info("Enable auto-login at my user")
-    sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'autoLoginUser', '-string', SHELL_USER]].run()
+    _run_all([
+        sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'GuestEnabled', '-bool', 'false']],
+        sudo[defaults['write', '/Library/Preferences/com.apple.loginwindow', 'autoLoginUser', '-string', SHELL_USER]],
+    ])
 
-    # _info("Set login itens")
-    # waiting on PR: https://github.com/OJFord/loginitems/pull/2
+    # login items are synced with .loginitems by brew(), once the apps are installed
 
     _ok()
 
@@ -1047,18 +3391,18 @@ def conf_osx__hardware():
     _grass("SSD tweaks")
 
     _info("Disable hibernation (speeds up entering sleep mode)")
-    pmset['-a', 'hibernatemode', '0'].run()
-
     _info("Remove the sleep image file to save disk space")
-    chflags['nouchg', '/private/var/vm/sleepimage'].run()
-    rmrf['/private/var/vm/sleepimage'].run()
-    # Create a zero-byte file instead
-    touch['/private/var/vm/sleepimage'].run()
-    # and make sure it can’t be rewritten
-    chflags['uchg', '/private/var/vm/sleepimage'].run()
-
     _info("Disable the sudden motion sensor as it’s not useful for SSDs")
-    pmset['-a', 'sms', '0'].run()
+    _run_all([
+        pmset['-a', 'hibernatemode', '0'],
+        chflags['nouchg', '/private/var/vm/sleepimage'],
+        rmrf['/private/var/vm/sleepimage'],
+        # Create a zero-byte file instead
+        touch['/private/var/vm/sleepimage'],
+        # and make sure it can’t be rewritten
+        chflags['uchg', '/private/var/vm/sleepimage'],
+        pmset['-a', 'sms', '0'],
+    ])
 
     # Restart automatically if the computer freezes
     # sudo systemsetup -setrestartfreeze on;ok
@@ -1084,8 +3428,7 @@ def conf_osx__hardware():
         dev_entry = df['/'].run()[1].split('\n')[1].split(' ')[0]
         volume_name = diskutil['info', dev_entry].run()[1].split('Volume Name:')[1].split('\n',1)[0].strip()
         ntfs_file = "/Volumes/" + volume_name + "/sbin/mount_ntfs"
-        sudo[mv[ntfs_file, ntfs_file+".orig"]].run()
-        sudo[ln["-s", "/usr/local/sbin/mount_ntfs", ntfs_file]].run()
+        _run_all([ sudo[mv[ntfs_file, ntfs_file+".orig"]], sudo[ln["-s", "/usr/local/sbin/mount_ntfs", ntfs_file]] ])
 
     _ok()
 
@@ -1142,26 +3485,65 @@ def conf_osx__other():
     _ok()
 
 
+# extension -> bundle id of the app that opens it
+FILE_ASSOCIATIONS = collections.OrderedDict([
+    ('.txt', 'com.microsoft.VSCode'),
+    ('.zip', 'com.macpaw.site.theunarchiver'),
+    ('.rar', 'com.macpaw.site.theunarchiver'),
+    ('.7z', 'com.macpaw.site.theunarchiver'),
+])
+# LaunchServices keeps the handlers by content type, which is what duti turns the extensions into
+EXTENSION_UTIS = {
+    '.txt': 'public.plain-text',
+    '.zip': 'public.zip-archive',
+    '.rar': 'com.rarlab.rar-archive',
+    '.7z': 'org.7-zip.7-zip-archive',
+}
+LAUNCHSERVICES_PATH = '~/Library/Preferences/com.apple.LaunchServices/com.apple.launchservices.secure.plist'
+
+def _file_handlers():
+    """Current handler (for all roles) per extension and content type."""
+    handlers = {}
+    for handler in (_load_plist(_abspath(LAUNCHSERVICES_PATH)) or {}).get('LSHandlers', []):
+        bundle_id = handler.get('LSHandlerRoleAll')
+        if bundle_id is None:
+            continue
+        # LaunchServices lowercases the bundle ids
+        if handler.get('LSHandlerContentTagClass') == 'public.filename-extension':
+            handlers['.' + handler.get('LSHandlerContentTag', '')] = bundle_id.lower()
+        elif 'LSHandlerContentType' in handler:
+            handlers[handler['LSHandlerContentType']] = bundle_id.lower()
+    return handlers
+
 def conf_osx__extensions():
     duti = local['duti']
+    printf = local['printf']
 
     _grass("Configuring applications to open certain files")
 
-    duti["-s", "com.microsoft.VSCode", ".txt", "all"].run()
-    duti["-s", "com.macpaw.site.theunarchiver", ".zip", "all"].run()
-    duti["-s", "com.macpaw.site.theunarchiver", ".rar", "all"].run()
-    duti["-s", "com.macpaw.site.theunarchiver", ".7z", "all"].run()
+    handlers = _file_handlers()
+    changed = [ (ext, bundle_id) for ext, bundle_id in FILE_ASSOCIATIONS.items()
+                if bundle_id.lower() not in (handlers.get(ext), handlers.get(EXTENSION_UTIS.get(ext))) ]
+    if not changed:
+        _info("All " + str(len(FILE_ASSOCIATIONS)) + " associations are already set")
+    else:
+        _info("Setting " + ', '.join(bundle_id + " for '" + ext + "'" for ext, bundle_id in changed))
+        # one duti reading a settings file from stdin, instead of one 'duti -s' per extension
+        settings = [ bundle_id + '\t' + EXTENSION_UTIS.get(ext, ext) + '\tall' for ext, bundle_id in changed ]
+        (printf[['%s\n'] + settings] | duti).run()
 
     _ok()
 
 
 def conf_osx():
+    run_steps(['conf_osx'])
+
+
+def conf_osx__prepare():
     killall = local['killall']
     openapp = local['open']
 
 
-    _snek("Configuring macOS settings")
-
     _grass("Linking apps to /usr/local/bin")
     _create_symlink("/usr/libexec/ApplicationFirewall/socketfilterfw", "/usr/local/bin/socketfilterfw")
     _ok()
@@ -1174,21 +3556,6 @@ def conf_osx():
     killall.run('System Preferences', retcode=None)
     _ok()
 
-    conf_osx__general()
-    conf_osx__dock()
-    conf_osx__mission_control()
-    conf_osx__language()
-    conf_osx__sec()
-    # conf_osx__spotlight()
-    conf_osx__keyboard()
-    conf_osx__trackpad()
-    conf_osx__timemachine()
-    conf_osx__menubar()
-    conf_osx__finder()
-    conf_osx__hardware()
-    conf_osx__extensions()
-    conf_osx__other()
-
 
 def macos_calendar():
     defaults = local['defaults']
@@ -1263,6 +3630,8 @@ def macos_textedit():
     _ok()
 
 
+@_needs_app('com.google.Chrome')
+@_budgeted(10*60, on_timeout='skip')
 def google_chrome():
     defaults = local['defaults']
     openapp = local["open"]
@@ -1271,7 +3640,7 @@ def google_chrome():
     _grass("Setting up >Google Chrome<")
 
     _info("Opening Chrome for you to setup your account")
-    openapp['/Applications/Google Chrome.app'].run()
+    openapp[_app_path('com.google.Chrome', '/Applications/Google Chrome.app')].run()
     _wait_for_file(_user_defaults('com.google.Chrome'))
 
     _info("Allow installing user scripts via GitHub Gist")
@@ -1286,21 +3655,42 @@ def google_chrome():
     _ok()
 
 
+ITERM_DOMAIN = 'com.googlecode.iterm2'
+# machine specific state in the plist that we never copy around
+ITERM_UNMANAGED_PREFIXES = ('NoSync', 'NSNav', 'NSSplitView', 'NSTableView', 'NSToolbar', 'NSWindow Frame', 'SU', 'iTerm Version')
+# who wins when both the repo and the machine have a value: 'repo' or 'live'
+ITERM_PRECEDENCE = 'repo'
+
+@_needs_app(ITERM_DOMAIN)
 def iterm():
-    defaults = local['defaults']
-    openapp = local["open"]
+    killall = local['killall']
 
 
     _grass("Setting iTerm2")
 
-    _info("Opening iTerm2 for you to setup your profile")
-    openapp['/Applications/iTerm.app'].run()
-
-    # _wait_for_file("~/Library/Preferences/com.googlecode.iterm2.plist")
+    _info("Merging the repo's iTerm2 preferences into the current ones")
+    managed = _load_plist(os.path.join(REPO_PATH, ITERM_DOMAIN + '.plist'))
+    if managed is None:
+        _warn("No iTerm2 preferences found at '" + ITERM_DOMAIN + ".plist'. Skipping.")
+        return
+    managed = { k: v for k, v in managed.items() if not k.startswith(ITERM_UNMANAGED_PREFIXES) }
+
+    live_path = _user_defaults(ITERM_DOMAIN)
+    live = _load_plist(live_path) or {}
+    merged = _merge_plist(live, managed, ITERM_PRECEDENCE)
+    # when auditing it's noted even if it matches, so it shows up as checked
+    if merged == live and EXPECTED is None:
+        _info("Already up to date")
+    else:
+        _write_file(live_path, plistlib.dumps(merged, fmt=plistlib.FMT_BINARY))
+        # otherwise cfprefsd keeps handing out (and writing back) its cached copy
+        killall['cfprefsd'].run(retcode=None)
 
     _ok()
 
 
+@_needs_app('com.microsoft.VSCode')
+@_budgeted(10*60, on_timeout='skip')
 def vscode():
     openapp = local['open']
 
@@ -1308,8 +3698,9 @@ def vscode():
     _grass("Set Visual Studio Code settings")
 
     _info("Waiting for VSCode binaries to be available ...")
-    _wait_for_file("/Applications/Visual Studio Code.app/Contents/Resources/app/bin/code")
-    vscode = local['/Applications/Visual Studio Code.app/Contents/Resources/app/bin/code']
+    code_path = os.path.join(_app_path('com.microsoft.VSCode', '/Applications/Visual Studio Code.app'), 'Contents/Resources/app/bin/code')
+    _wait_for_file(code_path)
+    vscode = local[code_path]
 
     _info("Installing Settings Sync extension")
     sync_extensionid = 'Shan.code-settings-sync'
@@ -1318,38 +3709,40 @@ def vscode():
     if sync_extensionid not in vscode['--list-extensions'].run()[1]:
         _info("Waiting for Settings Sync extension to be installed ...")
         openapp["vscode:extension/" + sync_extensionid].run()
-        while sync_extensionid not in vscode['--list-extensions'].run()[1]:
+        while sync_extensionid not in vscode['--list-extensions'].run()[1] and not _simulated():
             time.sleep(1)
 
     vscodedir_path = os.path.join(USER_PATH, "Library/Application Support/Code/User/")
     _info("Symlink Settings Sync local settings file")
-    local_settings_filepath = os.path.join(vscodedir_path, "syncLocalSettings.json")
-    _create_symlink("./vscode_sync_settings.json", local_settings_filepath)
+    local_settings_filepath = _create_symlink("./vscode_sync_settings.json", os.path.join(vscodedir_path, "syncLocalSettings.json"))
+    if local_settings_filepath is None:
+        _warn("No Settings Sync local settings found at 'vscode_sync_settings.json'. Skipping.")
+        return
 
     _info("Check if Settings Sync VSCode settings are set")
-    vscode_settings_filepath = os.path.join(vscodedir_path, "settings.json")
+    vscode_settings_filepath = _abspath(os.path.join(vscodedir_path, "settings.json"))
 
     # make sure the settings file exists
-    open(vscode_settings_filepath, 'a').close()
+    _touch(vscode_settings_filepath)
 
     # write the gist id to the file
-    with open(vscode_settings_filepath, 'r+') as vsf, open(local_settings_filepath, 'r') as syncf:
+    with open(local_settings_filepath, 'r') as syncf:
         local_settings_json = json.load(syncf)
-        # loads settings even if empty file
-        try:
+    # loads settings even if empty file (or missing, when auditing)
+    try:
+        with open(vscode_settings_filepath, 'r') as vsf:
             vscode_settings_json = json.load(vsf)
-        except ValueError:
-            vscode_settings_json = {}
+    except (ValueError, FileNotFoundError):
+        vscode_settings_json = {}
 
-        # write the sync settings token into the vscode settings
-        vscode_settings_json['sync.gist'] = local_settings_json['gist']
-        vsf.seek(0)
-        json.dump(vscode_settings_json, vsf, indent=4)
-        vsf.truncate()
+    # write the sync settings token into the vscode settings
+    vscode_settings_json['sync.gist'] = local_settings_json['gist']
+    _write_file(vscode_settings_filepath, json.dumps(vscode_settings_json, indent=4))
 
     _ok()
 
 
+@_needs_app('org.m0k.transmission')
 def transmission():
     defaults = local['defaults']
 
@@ -1375,6 +3768,7 @@ def transmission():
     _ok()
 
 
+@_needs_app('com.mendeley.Mendeley Desktop')
 def mendeley():
     defaults = local['defaults']
 
@@ -1399,6 +3793,7 @@ def mendeley():
     _ok()
 
 
+@_needs_app('com.macpaw.site.theunarchiver', 'cx.c3.theunarchiver')
 def unarchiver():
     defaults = local['defaults']
 
@@ -1420,12 +3815,17 @@ def unarchiver():
     _ok()
 
 
+@_needs_app('com.runningwithcrayons.Alfred', 'com.runningwithcrayons.Alfred-3')
 def alfred():
     openapp = local['open']
 
 
     _grass("Setting up >Alfred<")
 
+    _info("Syncing Alfred preferences")
+    synced = _sync_tree('Alfred.alfredpreferences', '~/Library/Application Support/Alfred 3/Alfred.alfredpreferences')
+    _info("Checked " + str(synced['files']) + " files: " + str(synced['copied']) + " copied (" + str(synced['bytes'] // 1024) + " KB), " + str(synced['removed']) + " removed")
+
     # check if alfred is installed
     _download_file('https://github.com/packal/repository/raw/master/com.shawn.patrick.rice.caffeinate.control/caffeinate_control.alfredworkflow','/tmp/')
     # openapp['/tmp/caffeinate_control.alfredworkflow'].run()
@@ -1433,25 +3833,14 @@ def alfred():
     _ok()
 
 
+@_needs_app('com.surteesstudios.Bartender')
 def bartender():
     _grass("Setting up >Bartender<")
     _ok()
 
 
 def conf_apps():
-
-    _snek("Configuring Applications")
-
-    macos_calendar()
-    macos_terminal()
-    macos_activitymonitor()
-    macos_textedit()
-    google_chrome()
-    iterm()
-    vscode()
-    transmission()
-    mendeley()
-    unarchiver()
+    run_steps(['conf_apps'])
 
 
 def teardown():
@@ -1462,22 +3851,21 @@ def teardown():
 
     # Remove outdated versions from the cellar
     _grass("Cleaning up homebrew cache")
-    brew['cleanup'] & FG
+    _background('brew-cleanup', brew['cleanup'])
     _ok()
 
-    _grass("Killing affected applications (so they can reboot)....")
-    APPS_TO_KILL=[
-        "Activity Monitor", "Address Book", "Calendar", "Contacts", "cfprefsd",
-        "Dock", "Finder", "Mail", "Messages", "SystemUIServer", "iCal", "Transmission",
-        "Visual Studio Code", "The Unarchiver",
-    ]
-    for app in APPS_TO_KILL:
+    _grass("Killing the applications whose settings changed (so they can reboot)....")
+    changed = _changed_domains()
+    apps_to_kill = collections.OrderedDict.fromkeys(app for domain in changed for app in RESTART_PROCESSES[domain])
+    if not apps_to_kill:
+        _info("No settings changed, nothing to restart")
+    for app in apps_to_kill:
         _info("Killing " + app + " ... ", end='', flush=True)
         ret = killall[app].run(retcode=None)
         # get all return strings, write done if no string was there
         ret = ret[2].rstrip("\n")
         if not ret: ret = 'done'
-        print(ret)
+        _safe_print(ret)
     _ok()
 
     _snek("Unfortunately I can't setup everything :( Heres a list of things you need to manually do.")
@@ -1513,7 +3901,7 @@ def teardown():
     """
 
     # print and save to file
-    print(post_mortem)
+    _safe_print(post_mortem)
 
 
 def update_brew():
@@ -1538,7 +3926,223 @@ def backup_osx():
         f.write(dockutil['--list'].run()[1])
 
 
+#########################
+# Step registry
+#
+# The steps --only/--skip pick from, in the order a full run goes through them,
+# with the steps each one needs first. Those that are only needed for the
+# globals they set (personal info, SIP status) are loaded instead of run, which
+# reads the values without asking anything or changing the machine.
+
+def _load_personal_info():
+    global USER_NAME, USER_EMAIL, GITHUB_USR, MAC_NAME
+    GITHUB_USR = GITHUB_USR or _prefetched('github_user', '')
+    USER_NAME = USER_NAME or _prefetched('user_name', '')
+    USER_EMAIL = USER_EMAIL or _prefetched('user_email', '')
+    MAC_NAME = MAC_NAME or _prefetched('computer_name', '')
+
+def _load_sip():
+    if SIP_ENABLED is None:
+        check_sip()
+
+STEP_LOADERS = {
+    'personal_info': _load_personal_info,
+    'check_sip': _load_sip,
+}
+
+STEP_GROUPS = collections.OrderedDict([
+    ('conf_osx', "Configuring macOS settings"),
+    ('conf_apps', "Configuring Applications"),
+])
+
+CONF_OSX_NEEDS = ['conf_osx__prepare']
+# step -> (function, group, steps it needs first, part of a full run)
+STEPS = collections.OrderedDict((step.__name__, (step, group, needs, full)) for step, group, needs, full in [
+    (check_sip, None, [], True),
+    (personal_info, None, [], True),
+    (git, None, ['personal_info'], True),
+    (brew, None, [], True),
+    (shell, None, [], True),
+    (conf_osx__prepare, 'conf_osx', [], True),
+    (conf_osx__general, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__dock, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__mission_control, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__language, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__sec, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__spotlight, 'conf_osx', CONF_OSX_NEEDS, False),
+    (conf_osx__keyboard, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__trackpad, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__timemachine, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__menubar, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__login, 'conf_osx', CONF_OSX_NEEDS, False),
+    (conf_osx__finder, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__hardware, 'conf_osx', CONF_OSX_NEEDS + ['check_sip'], True),
+    (conf_osx__extensions, 'conf_osx', CONF_OSX_NEEDS, True),
+    (conf_osx__other, 'conf_osx', CONF_OSX_NEEDS, True),
+    (macos_calendar, 'conf_apps', [], True),
+    (macos_terminal, 'conf_apps', [], True),
+    (macos_activitymonitor, 'conf_apps', [], True),
+    (macos_textedit, 'conf_apps', [], True),
+    (google_chrome, 'conf_apps', [], True),
+    (iterm, 'conf_apps', [], True),
+    (vscode, 'conf_apps', [], True),
+    (transmission, 'conf_apps', [], True),
+    (mendeley, 'conf_apps', [], True),
+    (unarchiver, 'conf_apps', [], True),
+    (alfred, 'conf_apps', [], True),
+    (bartender, 'conf_apps', [], False),
+    (teardown, None, [], True),
+    # what --update runs
+    (update_brew, None, [], False),
+    (update_gitignore, None, [], False),
+    (update_osx, None, [], False),
+    (backup_osx, None, [], False),
+])
+
+def _expand_steps(names):
+    for name in names:
+        if name in STEP_GROUPS:
+            yield from (n for n, (_, group, _, full) in STEPS.items() if group == name and full)
+        elif name in STEPS:
+            yield name
+        else:
+            raise ValueError("Unknown step '" + name + "' (see --list-steps)")
+
+def resolve_steps(only=None, skip=()):
+    """[(step, 'run' or 'load')] in run order for the selected steps and what they need."""
+    skipped = set(_expand_steps(skip))
+    selected = set(_expand_steps(only)) if only else { n for n, s in STEPS.items() if s[3] }
+    selected -= skipped
+
+    needed, pending = set(), list(selected)
+    while pending:
+        for need in STEPS[pending.pop()][2]:
+            # loaded steps don't pull in what they'd need to run
+            if need not in needed and need not in skipped:
+                needed.add(need)
+                if need in selected or need not in STEP_LOADERS:
+                    pending.append(need)
+
+    plan = []
+    for name in STEPS:
+        if name in selected:
+            plan.append((name, 'run'))
+        elif name in needed:
+            plan.append((name, 'load' if name in STEP_LOADERS else 'run'))
+    return plan
+
+def run_steps(only=None, skip=()):
+    group = None
+    for name, action in resolve_steps(only, skip):
+        step, step_group = STEPS[name][:2]
+        if action == 'load':
+            _debug("Loading what '" + name + "' sets up, without running it")
+            STEP_LOADERS[name]()
+            continue
+        if step_group is not None and step_group != group:
+            _snek(STEP_GROUPS[step_group])
+        group = step_group
+        failed_needs = [ need for need in STEPS[name][2] if need in FAILED_STEPS ]
+        if failed_needs:
+            _warn("Skipping '" + name + "', '" + "' and '".join(failed_needs) + "' didn't finish")
+            FAILED_STEPS.append(name)
+            continue
+        with _log_group():
+            try:
+                (_profiled(name, step) if PROFILE_PATH else step)()
+            except CommandTimeout as e:
+                if e.scope == 'run':
+                    raise
+                _warn("Step '" + name + "' failed: " + str(e))
+                FAILED_STEPS.append(name)
+
+def list_steps():
+    for name, (step, group, needs, full) in STEPS.items():
+        notes = ([ 'in ' + group ] if group else []) + ([ 'needs ' + ', '.join(needs) ] if needs else []) + ([] if full else [ 'only when picked' ])
+        _safe_print(name.ljust(28) + '; '.join(notes), kind='report', level=LOG_QUIET)
+
+
+def provision_homes(homes, worker_args):
+    _snek("Provisioning " + str(len(homes)) + " homes under '" + ROOT_PATH + "'")
+
+    # one worker process per home, each one is a regular run with its own --home
+    def provision(home):
+        cmd = [sys.executable, os.path.abspath(__file__), '--home', home] + worker_args
+        return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(homes)) as pool:
+        workers = { pool.submit(provision, home): home for home in homes }
+        for worker in concurrent.futures.as_completed(workers):
+            home, proc = workers[worker], worker.result()
+            with _log_group():
+                _grass("Output for '" + home + "'")
+                _safe_print(proc.stdout.decode('utf-8', 'replace'))
+                if proc.returncode != 0:
+                    _warn("Provisioning '" + home + "' failed with exit code " + str(proc.returncode))
+                    failed.append(home)
+
+    _snek("Provisioned " + str(len(homes) - len(failed)) + " of " + str(len(homes)) + " homes.")
+    return failed
+
+
+BAKE_EXISTING_HOME_DIRS = ['Library', 'Library/Preferences', 'Library/Application Support']
+
+def bake(out_path):
+    _snek("Baking the staged run into '" + out_path + "'")
+
+    # home directories go to the user, everything else to root, and only the
+    # directories we created inside the home are packed so extracting doesn't
+    # touch the modes of existing ones like /Library or ~/Library
+    home = USER_PATH.strip(os.sep)
+    existing_dirs = [ os.path.join(home, d) for d in BAKE_EXISTING_HOME_DIRS ]
+    def in_home(name):
+        return name.startswith(home + os.sep) and name not in existing_dirs
+
+    def owner(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname, tarinfo.gname = (SHELL_USER, 'staff') if in_home(tarinfo.name) else ('root', 'wheel')
+        return tarinfo
+
+    baked = []
+    for dirpath, dirnames, filenames in os.walk(ROOT_PATH):
+        for name in sorted(dirnames) + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            arcname = os.path.relpath(path, ROOT_PATH)
+            # os.walk lists symlinks to dirs as dirs, but we pack them as links
+            if os.path.isdir(path) and not os.path.islink(path) and not in_home(arcname):
+                continue
+            baked.append((path, arcname))
+
+    if out_path.endswith(('.tar', '.tar.gz', '.tgz')):
+        with tarfile.open(out_path, 'w:gz' if out_path.endswith('gz') else 'w') as tar:
+            for path, arcname in baked:
+                tar.add(path, arcname=arcname, recursive=False, filter=owner)
+        base_path = out_path[:-len('.tar')] if out_path.endswith('.tar') else out_path.rsplit('.t', 1)[0]
+        _info("Deploy with: sudo tar -xpf '" + out_path + "' -C /")
+    else:
+        # overlay directory, mirrors the root as is
+        shutil.copytree(ROOT_PATH, out_path, symlinks=True, dirs_exist_ok=True)
+        base_path = out_path.rstrip(os.sep)
+        _info("Deploy with: sudo rsync -a '" + base_path + "/' /")
+
+    # what couldn't be baked is kept as a journal, and compiled so it can be replayed after extracting
+    manifest_path = base_path + '.manifest.jsonl'
+    _save_journal(manifest_path)
+    script_path = compile_journal(manifest_path, base_path + '.sh')
+
+    _info("Symlinks point into '" + REPO_PATH + "', the repo has to be at the same path when deploying")
+    _info("Then run the remaining actions with: sh '" + script_path + "'")
+    _ok("Baked " + str(len(baked)) + " files")
+    return out_path
+
+
 if __name__ == '__main__':
+    # we are the privileged helper of another run (see _privileged_helper)
+    if sys.argv[1:] == ['--privileged-helper']:
+        privileged_helper()
+        exit(0)
+
     installed_packages = install_pip_packages()
 
     # parse some flags
@@ -1546,17 +4150,103 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--force', '-f', action='store_true')
     parser.add_argument('--update', '-u', action='store_true')
-    parser.add_argument('--method', '-m', type=str)
+    parser.add_argument('--only', '--method', '-m', nargs='+', metavar='STEP', help="run only these steps (or groups, e.g. conf_osx), plus what they need")
+    parser.add_argument('--skip', nargs='+', metavar='STEP', default=[], help="leave these steps (or groups) out of the run")
+    parser.add_argument('--list-steps', action='store_true', help="list the steps --only and --skip take")
+    parser.add_argument('--answers', '-a', type=str, help="JSON file with the answers to the prompts, for unattended runs")
+    parser.add_argument('--record', type=str, help="record every change this run makes into a journal file")
+    parser.add_argument('--compile', type=str, help="compile a recorded journal into a standalone shell script")
+    parser.add_argument('--output', '-o', type=str, help="output path for --compile")
+    parser.add_argument('--root', type=str, help="stage everything under this directory instead of the live machine")
+    parser.add_argument('--home', type=str, help="home directory to provision (default: the current user's)")
+    parser.add_argument('--homes', type=str, help="comma separated homes to provision in parallel under --root")
+    parser.add_argument('--bake', type=str, help="stage the run and pack it into a tar (or overlay directory) plus a manifest of the remaining actions")
+    parser.add_argument('--quiet', '-q', action='store_true', help="only print warnings")
+    parser.add_argument('--verbose', '-v', action='store_true', help="also print every command we run")
+    parser.add_argument('--log-json', type=str, help="append every message as NDJSON to this file")
+    parser.add_argument('--deadline', type=float, help="seconds the whole run may take, commands still running after that are killed")
+    parser.add_argument('--verify', action='store_true', help="check the machine against the settings we manage, without changing anything")
+    parser.add_argument('--json', action='store_true', help="print the --verify (or --bench-shell) report as JSON")
+    parser.add_argument('--watch', action='store_true', help="keep checking the files we manage for drift as they change")
+    parser.add_argument('--fix', action='store_true', help="with --watch, re-apply what drifts instead of only reporting it")
+    parser.add_argument('--bench-shell', type=int, metavar='RUNS', help="time RUNS interactive zsh startups and break down where the time goes")
+    parser.add_argument('--history', nargs='*', metavar='FILE', help="compact ~/.zsh_history, merging in the histories of other machines")
+    parser.add_argument('--profile', nargs='?', const='dotfyles-profile', metavar='DIR', help="profile every step into DIR (default: ./dotfyles-profile) and print the hotspots")
+    parser.add_argument('--trace-memory', action='store_true', help="also record what each step allocates, into the --profile dir")
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help="with --watch, max seconds between checks")
     args = parser.parse_args()
 
+    _log_setup(LOG_QUIET if args.quiet else (LOG_VERBOSE if args.verbose else LOG_NORMAL), args.log_json and os.path.abspath(args.log_json))
+
+    FORCE = args.force
+    if args.profile or args.trace_memory:
+        PROFILE_PATH = os.path.abspath(args.profile or 'dotfyles-profile')
+        TRACE_MEMORY = args.trace_memory
+        atexit.register(profile_report)
+    if args.deadline:
+        RUN_DEADLINE = time.time() + args.deadline
+
+    if args.root:
+        ROOT_PATH = os.path.abspath(args.root)
+    elif args.bake:
+        ROOT_PATH = tempfile.mkdtemp(prefix='dotfyles-bake-')
+    if args.home:
+        USER_PATH = os.path.normpath(args.home)
+        SHELL_USER = os.path.basename(USER_PATH)
+
+    if args.compile:
+        compile_journal(args.compile, args.output or os.path.splitext(args.compile)[0] + '.sh')
+        exit(0)
+
+    if args.answers:
+        with open(args.answers, 'r') as f:
+            ANSWERS = json.load(f)
+
     # import only after we install the pip packages
     import requests
-    from plumbum import local, FG, BG, TF, RETCODE
-    from plumbum.cmd import sudo, true, rm, ln, echo, tee, cp, mv, ls, find, grep
+    import plumbum
+    from plumbum import FG, BG, TF, RETCODE
+    local = _Machine()
+    sudo, true, rm, ln, echo, tee, cp, mv, ls, find, grep = [ local[c] for c in ('sudo', 'true', 'rm', 'ln', 'echo', 'tee', 'cp', 'mv', 'ls', 'find', 'grep') ]
+
+    if args.homes and (args.record or args.bake):
+        parser.error("--homes can't be used with --record or --bake, every worker would write the same file")
+    if args.record or args.bake:
+        JOURNAL = []
+    if args.record:
+        atexit.register(_save_journal, os.path.abspath(args.record))
+    if args.bake:
+        args.bake = os.path.abspath(args.bake)
+
+    if args.homes:
+        if not (args.root and args.answers):
+            parser.error("--homes needs --root and --answers, the workers can't prompt")
+        # workers get the same flags, minus --homes
+        worker_args = [ a for i, a in enumerate(sys.argv[1:]) if not (a.startswith('--homes') or sys.argv[i] == '--homes') ]
+        exit(1 if provision_homes(args.homes.split(','), worker_args) else 0)
+
+    if args.list_steps:
+        list_steps()
+        exit(0)
 
-    # if only one function was called
-    if args.method:
-        locals()[args.method]()
+    try:
+        resolve_steps(args.only, args.skip)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.verify:
+        os.chdir(REPO_PATH)
+        exit(verify(as_json=args.json))
+
+    if args.history is not None:
+        exit(history(args.history))
+
+    if args.bench_shell:
+        exit(bench_shell(args.bench_shell, as_json=args.json))
+
+    if args.watch:
+        os.chdir(REPO_PATH)
+        watch(fix=args.fix, interval=args.interval)
         exit(0)
 
     _snek("Starting! Hissss...")
@@ -1566,30 +4256,40 @@ if __name__ == '__main__':
     caff = caffeinate.popen("-i -d")
 
     # change working dir to this script dir
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(REPO_PATH)
 
-    if args.update:
-        update_brew()
-        update_gitignore()
-        update_osx()
-        backup_osx()
+    # start read-only lookups while we wait on the user, picked steps only run the ones they use
+    if not args.only:
+        start_prefetch()
 
-        _grass("Consider reviewing these changes and commiting.")
-        _snek("Hissss. All done!")
-    else:
-        check_sip(double_check=False)
-        personal_info()
-        git()
-        brew()
-        shell()
-        conf_osx()
-        conf_apps()
-        teardown()
-
-        # uninstall pip packages
-        uninstall_pip_packages(installed_packages)
-        caff.terminate()
-
-        _grass("Note that some of these changes require a logout/restart to take effect.")
-        _grass("You should also NOT open System Preferences. It might overwrite some of the settings.")
-        _snek("Hissss. All done!")
\ No newline at end of file
+    try:
+        if args.update:
+            run_steps(['update_brew', 'update_gitignore', 'update_osx', 'backup_osx'])
+            wait_background()
+
+            _grass("Consider reviewing these changes and commiting.")
+            _snek("Hissss. All done!" if not FAILED_STEPS else "Done, but '" + "', '".join(FAILED_STEPS) + "' didn't finish ... Hisss.")
+        else:
+            run_steps(args.only, args.skip)
+
+            # uninstall pip packages
+            uninstall_pip_packages(installed_packages)
+            wait_background()
+            caff.terminate()
+
+            if args.bake:
+                bake(args.bake)
+                if not args.root: shutil.rmtree(ROOT_PATH)
+
+            _grass("Note that some of these changes require a logout/restart to take effect.")
+            _grass("You should also NOT open System Preferences. It might overwrite some of the settings.")
+            _snek("Hissss. All done!" if not FAILED_STEPS else "Done, but '" + "', '".join(FAILED_STEPS) + "' didn't finish ... Hisss.")
+    except CommandTimeout as e:
+        _warn(str(e))
+        wait_background()
+        _snek("Ran out of time ... Hisss.")
+        exit(3)
+
+    # like running out of time, the steps that didn't finish need another run
+    if FAILED_STEPS:
+        exit(3)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import importlib.util
+import os
+import sys
+import types
+
+try:
+    import plumbum
+except ImportError:
+    plumbum = None
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_dotfyles():
+    # dotfyles.py imports pip's internals to install its own requirements, which
+    # newer pips don't have anymore and the tests don't need
+    try:
+        from pip._internal.utils.misc import get_installed_distributions
+    except ImportError:
+        for name in ('pip', 'pip._internal', 'pip._internal.utils', 'pip._internal.utils.misc'):
+            sys.modules[name] = types.ModuleType(name)
+        sys.modules['pip._internal'].main = lambda args: 0
+        sys.modules['pip._internal'].utils = sys.modules['pip._internal.utils']
+        sys.modules['pip._internal.utils.misc'].get_installed_distributions = lambda: []
+
+    spec = importlib.util.spec_from_file_location('dotfyles', os.path.join(REPO_PATH, 'dotfyles.py'))
+    dotfyles = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dotfyles)
+    return dotfyles
+
+
+def staged_dotfyles(tmp, user='alice'):
+    """dotfyles, set up to stage a run for user under tmp/stage."""
+    dotfyles = load_dotfyles()
+    dotfyles.plumbum = plumbum
+    dotfyles.local = dotfyles._Machine()
+    # the commands main() sets up
+    for name in ('sudo', 'true', 'rm', 'ln', 'echo', 'tee', 'cp', 'mv', 'ls', 'find', 'grep'):
+        setattr(dotfyles, name, dotfyles.local[name])
+    if plumbum is not None:
+        dotfyles.FG, dotfyles.BG, dotfyles.TF, dotfyles.RETCODE = plumbum.FG, plumbum.BG, plumbum.TF, plumbum.RETCODE
+    dotfyles.ROOT_PATH = os.path.join(tmp, 'stage')
+    dotfyles.USER_PATH = '/Users/' + user
+    dotfyles.SHELL_USER = user
+    dotfyles.LOG_LEVEL = dotfyles.LOG_QUIET
+    return dotfyles
@@ -0,0 +1,74 @@
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+
+class NeedsAppTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.LOG_LEVEL = self.d.LOG_QUIET
+        self.d.APPLICATION_DIRS = [ os.path.join(self.tmp, 'Applications') ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def install(self, name, bundle_id):
+        contents = os.path.join(self.tmp, 'Applications', name + '.app', 'Contents')
+        os.makedirs(contents)
+        with open(os.path.join(contents, 'Info.plist'), 'wb') as f:
+            plistlib.dump({ 'CFBundleIdentifier': bundle_id }, f)
+
+    def runs(self, *bundle_ids):
+        ran = []
+        self.d._needs_app(*bundle_ids)(lambda: ran.append(True))()
+        return bool(ran)
+
+    def test_any_of_the_ids_will_do(self):
+        self.install('Alfred 4', 'com.runningwithcrayons.Alfred')
+        self.assertTrue(self.runs('com.runningwithcrayons.Alfred', 'com.runningwithcrayons.Alfred-3'))
+        self.assertFalse(self.runs('com.runningwithcrayons.Alfred-3'))
+
+    def test_steps_use_the_ids_the_casks_install(self):
+        self.install('The Unarchiver', 'com.macpaw.site.theunarchiver')
+        self.install('Alfred 4', 'com.runningwithcrayons.Alfred')
+        ran = []
+        self.d.local = _Recorder(ran)
+        self.d._sync_tree = lambda *args: ran.append('alfred') or { 'files': 0, 'copied': 0, 'bytes': 0, 'removed': 0 }
+        self.d._download_file = lambda *args: None
+        self.d.unarchiver()
+        self.d.alfred()
+        self.assertIn('defaults', ran)
+        self.assertIn('alfred', ran)
+
+    def test_skips_when_missing(self):
+        self.assertFalse(self.runs('com.example.Missing'))
+
+
+class _Recorder(object):
+    """Stands in for the command runner, noting which programs ran."""
+    def __init__(self, ran):
+        self.ran = ran
+
+    def __getitem__(self, name):
+        return _RecordedCommand(self.ran, name)
+
+
+class _RecordedCommand(object):
+    def __init__(self, ran, name):
+        self.ran, self.name = ran, name
+
+    def __getitem__(self, args):
+        return self
+
+    def run(self, *args, **kwargs):
+        self.ran.append(self.name)
+        return (0, '', '')
+
+
+if __name__ == '__main__':
+    unittest.main()
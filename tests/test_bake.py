@@ -0,0 +1,75 @@
+import json
+import os
+import shlex
+import shutil
+import tempfile
+import unittest
+
+from support import REPO_PATH, plumbum, staged_dotfyles
+
+
+@unittest.skipIf(plumbum is None, "plumbum is not installed")
+class BakeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = staged_dotfyles(self.tmp)
+        self.d.JOURNAL = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def stage_run(self):
+        d, local = self.d, self.d.local
+        # the same kinds of commands shell() and conf_osx() run
+        which_zsh = local['which']['zsh'].run(retcode=None)[1].rstrip('\n') or '/bin/zsh'
+        local['sudo']['chsh', '-s', which_zsh, d.SHELL_USER].run()
+        local['chflags']['nohidden', d._abspath('~/Library')].run()
+        local['git']['clone', '--depth', '1', 'https://github.com/sindresorhus/pure.git', d._abspath('~/.cache/pure')].run()
+        local['cp']['-f', os.path.join(REPO_PATH, 'README.md'), d._abspath('~/README.md')].run()
+        local['defaults']['write', 'com.apple.dock', 'autohide', '-bool', 'true'].run()
+        local['killall']['Dock'].run()
+
+    def test_queries_run_when_staging(self):
+        self.assertEqual(self.d.local['which']['sh'].run(retcode=None)[1].rstrip('\n'), shutil.which('sh'))
+
+    def test_bake_has_no_staging_paths(self):
+        self.stage_run()
+        self.d.bake(os.path.join(self.tmp, 'baked'))
+
+        with open(os.path.join(self.tmp, 'baked.manifest.jsonl')) as f:
+            entries = [ json.loads(l) for l in f ]
+        commands = [ e['argv'] for e in entries if e['op'] == 'run' ]
+        self.assertIn(['chflags', 'nohidden', '/Users/alice/Library'], commands)
+        for argv in commands:
+            self.assertNotIn('', argv)
+            for arg in argv:
+                self.assertNotIn(self.d.ROOT_PATH, arg)
+
+        with open(os.path.join(self.tmp, 'baked.sh')) as f:
+            script = f.read()
+        self.assertNotIn(self.d.ROOT_PATH, script)
+        for line in script.splitlines():
+            if line and not line.startswith('#'):
+                self.assertNotIn('', shlex.split(line))
+
+    def test_compiled_plist_writes_come_before_the_restart(self):
+        journal_path = os.path.join(self.tmp, 'journal.jsonl')
+        with open(journal_path, 'w') as f:
+            for entry in [
+                { 'op': 'context', 'user': 'bob', 'user_path': '/Users/bob' },
+                { 'op': 'run', 'argv': ['defaults', 'write', 'com.apple.dock', 'autohide', '-bool', 'true'], 'cwd': '/Users/bob/dotfyles' },
+                { 'op': 'run', 'argv': ['killall', 'Dock'], 'cwd': '/Users/bob/dotfyles' },
+                { 'op': 'run', 'argv': ['brew', 'bundle', 'install', '--file=.Brewfile'], 'cwd': '/Users/bob/dotfyles' },
+            ]:
+                f.write(json.dumps(entry) + '\n')
+
+        script_path = self.d.compile_journal(journal_path, os.path.join(self.tmp, 'journal.sh'))
+        with open(script_path) as f:
+            lines = f.read().splitlines()
+        plistbuddy = next(i for i, l in enumerate(lines) if '/Users/bob/Library/Preferences/com.apple.dock.plist' in l)
+        self.assertLess(plistbuddy, lines.index('killall Dock'))
+        self.assertLess(lines.index('cd /Users/bob/dotfyles'), lines.index('brew bundle install --file=.Brewfile'))
+
+
+if __name__ == '__main__':
+    unittest.main()
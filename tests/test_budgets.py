@@ -0,0 +1,104 @@
+import collections
+import time
+import unittest
+
+from support import load_dotfyles, plumbum
+
+
+class StepsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.d = load_dotfyles()
+        # nothing printed, the warnings are expected
+        self.d.LOG_LEVEL = -1
+        self.calls = collections.Counter()
+
+    def timing_out(self, name, scope='command', times=1, step=None):
+        """A step whose command times out the first `times` runs."""
+        def step_func():
+            self.calls[name] += 1
+            if self.calls[name] <= times:
+                raise self.d.CommandTimeout('sleep 100', 1, scope, step)
+            return 'done'
+        step_func.__name__ = name
+        return step_func
+
+
+class BudgetTest(StepsTestCase):
+    def test_skip(self):
+        step = self.d._budgeted(60, on_timeout='skip')(self.timing_out('a'))
+        self.assertIsNone(step())
+        self.assertEqual(self.d.STEP_DEADLINES, [])
+
+    def test_retry(self):
+        step = self.d._budgeted(60, on_timeout='retry')(self.timing_out('a'))
+        self.assertEqual(step(), 'done')
+        self.assertEqual(self.calls['a'], 2)
+
+        step = self.d._budgeted(60, on_timeout='retry', retries=2)(self.timing_out('b', times=3))
+        with self.assertRaises(self.d.CommandTimeout):
+            step()
+        self.assertEqual(self.calls['b'], 3)
+
+    def test_fail(self):
+        step = self.d._budgeted(60)(self.timing_out('a'))
+        with self.assertRaises(self.d.CommandTimeout):
+            step()
+
+    def test_other_budgets_are_passed_on(self):
+        for scope, other in (('run', None), ('step', 'outer')):
+            step = self.d._budgeted(60, on_timeout='skip')(self.timing_out(scope, scope, step=other))
+            with self.assertRaises(self.d.CommandTimeout):
+                step()
+
+    def test_the_step_budget_bounds_its_commands(self):
+        def step():
+            return self.d._timeout_for('brew')
+        timeout, scope, name = self.d._budgeted(10)(step)()
+        self.assertEqual((scope, name), ('step', 'step'))
+        self.assertLessEqual(timeout, 10)
+
+        self.d.RUN_DEADLINE = time.time() + 5
+        self.assertEqual(self.d._budgeted(10)(step)()[1:], ('run', None))
+
+    @unittest.skipIf(plumbum is None, "plumbum is not installed")
+    def test_commands_are_killed(self):
+        self.d.plumbum = plumbum
+        self.d.local = self.d._Machine()
+        self.d.COMMAND_TIMEOUTS['sleep'] = 0.2
+        started = time.time()
+        with self.assertRaises(self.d.CommandTimeout) as raised:
+            self.d.local['sleep']['30'].run()
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual(raised.exception.scope, 'command')
+
+
+class StepTimeoutTest(StepsTestCase):
+    def steps(self, *steps):
+        self.d.STEPS = collections.OrderedDict((name, (step, None, needs, True)) for name, step, needs in steps)
+
+    def ok(self, name):
+        def step():
+            self.calls[name] += 1
+        return step
+
+    def test_a_timed_out_step_fails_alone(self):
+        self.steps(('a', self.timing_out('a'), []), ('b', self.ok('b'), ['a']), ('c', self.ok('c'), ['b']), ('d', self.ok('d'), []))
+        self.d.run_steps()
+        self.assertEqual(self.d.FAILED_STEPS, ['a', 'b', 'c'])
+        self.assertEqual(self.calls, {'a': 1, 'd': 1})
+
+    def test_budgeted_failures_fail_the_step(self):
+        self.steps(('a', self.d._budgeted(60)(self.timing_out('a', 'step', step='a')), []), ('b', self.ok('b'), []))
+        self.d.run_steps()
+        self.assertEqual(self.d.FAILED_STEPS, ['a'])
+        self.assertEqual(self.calls['b'], 1)
+
+    def test_the_run_deadline_stops_the_run(self):
+        self.steps(('a', self.timing_out('a', 'run'), []), ('b', self.ok('b'), []))
+        with self.assertRaises(self.d.CommandTimeout):
+            self.d.run_steps()
+        self.assertEqual(self.calls['b'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
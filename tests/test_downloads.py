@@ -0,0 +1,98 @@
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+import types
+import unittest
+
+from support import load_dotfyles
+
+DATA = bytes(range(256)) * 4096 + b'tail'
+
+
+class FakeResponse(object):
+    def __init__(self, data, headers, fail_after=None):
+        self.offset = int(headers['Range'][len('bytes='):-1]) if headers else 0
+        self.status_code = 206 if self.offset else 200
+        self.data, self.fail_after = data, fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for n, i in enumerate(range(self.offset, len(self.data), size)):
+            if n == self.fail_after:
+                raise ConnectionError("dropped")
+            time.sleep(0.001)
+            yield self.data[i:i + size]
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.LOG_LEVEL = self.d.LOG_QUIET
+        self.d.DOWNLOADS_CACHE_PATH = os.path.join(self.tmp, 'downloads')
+        self.d.DOWNLOAD_CHUNK_SIZE = 64 * 1024
+        self.requests = []
+        self.serve(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def serve(self, data, fail_after=None):
+        def get(url, headers, **kwargs):
+            self.requests.append((url, headers))
+            return FakeResponse(data, headers, fail_after)
+        self.d.requests = types.SimpleNamespace(get=get)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_concurrent_downloads_of_one_url(self):
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            paths = list(pool.map(lambda _: self.d._cached_download('http://example.com/a'), range(8)))
+        self.assertEqual(len(set(paths)), 1)
+        self.assertEqual(self.read(paths[0]), DATA)
+        # nothing half done is left behind, only the lock
+        self.assertEqual([ p for p in os.listdir(os.path.join(self.d.DOWNLOADS_CACHE_PATH, 'partial')) if not p.endswith('.lock') ], [])
+
+    def test_resumes_a_dropped_download(self):
+        self.serve(DATA, fail_after=3)
+        with self.assertRaises(ConnectionError):
+            self.d._cached_download('http://example.com/a')
+        self.serve(DATA)
+        path = self.d._cached_download('http://example.com/a')
+        self.assertEqual(self.read(path), DATA)
+        self.assertEqual(self.requests[-1][1], { 'Range': 'bytes=' + str(3 * self.d.DOWNLOAD_CHUNK_SIZE) + '-' })
+
+    def test_cached_unless_fresh(self):
+        self.d._cached_download('http://example.com/a')
+        self.serve(b'changed')
+        self.assertEqual(self.read(self.d._cached_download('http://example.com/a')), DATA)
+        self.assertEqual(self.read(self.d._cached_download('http://example.com/a', fresh=True)), b'changed')
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.d._cached_download('http://example.com/a', sha256='0' * 64)
+
+    def test_download_files_keeps_the_order(self):
+        urls = [ 'http://example.com/' + str(i) for i in range(6) ]
+        downloads = [ (url, os.path.join(self.tmp, 'out', str(i))) for i, url in enumerate(urls) ] + [ (urls[0], None) ]
+        paths = self.d._download_files(downloads)
+        self.assertEqual(paths[:-1], [ d[1] for d in downloads[:-1] ])
+        self.assertTrue(paths[-1].startswith(os.path.join(self.d.DOWNLOADS_CACHE_PATH, 'blobs')))
+        for path in paths:
+            self.assertEqual(self.read(path), DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()
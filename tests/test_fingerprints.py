@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+from support import load_dotfyles
+
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.USER_PATH = self.tmp
+        self.d.LOG_LEVEL = self.d.LOG_QUIET
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def define(self, source):
+        # compiled into the module, like the real steps
+        exec(textwrap.dedent(source), vars(self.d))
+
+    def fingerprint(self, name):
+        return self.d._fingerprint(getattr(self.d, name), [], [])
+
+    def test_changed_constant_invalidates(self):
+        self.define("""
+            def conf_test():
+                local['defaults']['write', 'com.apple.dock', 'tilesize', '-int', '45'].run()
+        """)
+        before = self.fingerprint('conf_test')
+        self.define("""
+            def conf_test():
+                local['defaults']['write', 'com.apple.dock', 'tilesize', '-int', '46'].run()
+        """)
+        self.assertNotEqual(before, self.fingerprint('conf_test'))
+
+    def test_changed_helper_invalidates(self):
+        self.define("""
+            def conf_test__helper():
+                return 'a'
+            def conf_test():
+                return conf_test__helper()
+        """)
+        before = self.fingerprint('conf_test')
+        self.define("""
+            def conf_test__helper():
+                return 'b'
+        """)
+        self.assertNotEqual(before, self.fingerprint('conf_test'))
+
+    def test_changed_module_constant_invalidates(self):
+        self.define("""
+            TEST_VERSION = 1
+            def conf_test():
+                return TEST_VERSION
+        """)
+        before = self.fingerprint('conf_test')
+        self.d.TEST_VERSION = 2
+        self.assertNotEqual(before, self.fingerprint('conf_test'))
+
+    def test_same_code_is_stable(self):
+        self.define("""
+            def conf_test():
+                return {'a', 'b', 'c'}
+        """)
+        self.assertEqual(self.fingerprint('conf_test'), self.fingerprint('conf_test'))
+
+    def test_only_successful_runs_are_saved(self):
+        runs = []
+        @self.d._fingerprinted()
+        def failing():
+            runs.append('failing')
+            return False
+        @self.d._fingerprinted()
+        def passing():
+            runs.append('passing')
+
+        failing(); failing()
+        passing(); passing()
+        self.assertEqual(runs, ['failing', 'failing', 'passing'])
+        self.assertEqual(sorted(self.d._load_fingerprints()), ['passing'])
+
+
+if __name__ == '__main__':
+    unittest.main()
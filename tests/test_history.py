@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.LOG_LEVEL = -1
+        self.d.USER_PATH = os.path.join(self.tmp, 'home')
+        os.makedirs(self.d.USER_PATH)
+        self.path = os.path.join(self.d.USER_PATH, '.zsh_history')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_keeps_the_latest_run_of_each_command(self):
+        self.write(self.path, b': 100:0;ls\n: 200:0;git status\n: 300:0;ls\n')
+        self.assertEqual(self.d.history(), 0)
+        self.assertEqual(self.read(self.path), b': 200:0;git status\n: 300:0;ls\n')
+
+    def test_merges_other_histories_by_time(self):
+        self.write(self.path, b': 100:0;ls\n: 300:0;make\n')
+        other = self.write(os.path.join(self.tmp, 'laptop'), b': 200:0;make\n: 400:0;ls\n: 500:0;cd /tmp\n')
+        self.assertEqual(self.d.history([other, os.path.join(self.tmp, 'missing')]), 0)
+        self.assertEqual(self.read(self.path), b': 300:0;make\n: 400:0;ls\n: 500:0;cd /tmp\n')
+        # the other ones are only read
+        self.assertEqual(self.read(other), b': 200:0;make\n: 400:0;ls\n: 500:0;cd /tmp\n')
+
+    def test_multiline_and_metafied_commands(self):
+        # zsh keeps the newlines of a command as '\\\n' and metafies non-ASCII bytes
+        multiline = b': 100:0;for f in *; do\\\n  echo $f\\\ndone'
+        metafied = b': 150:0;echo caf\x83\xa9'
+        self.write(self.path, multiline + b'\n' + metafied + b'\n: 200:0;ls\n' + multiline.replace(b'100', b'300') + b'\n')
+        self.d.history()
+        self.assertEqual(self.read(self.path), metafied + b'\n: 200:0;ls\n' + multiline.replace(b'100', b'300') + b'\n')
+
+    def test_plain_entries_keep_the_time_before_them(self):
+        self.write(self.path, b': 100:0;ls\npwd\n: 300:0;make\n')
+        other = self.write(os.path.join(self.tmp, 'laptop'), b': 200:0;whoami\n')
+        self.d.history([other])
+        self.assertEqual(self.read(self.path), b': 100:0;ls\npwd\n: 200:0;whoami\n: 300:0;make\n')
+
+    def test_rewrites_through_the_symlink(self):
+        real = self.write(os.path.join(self.tmp, 'repo_history'), b': 100:0;ls\n: 200:0;ls\n')
+        os.symlink(real, self.path)
+        self.d.history()
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(self.read(real), b': 200:0;ls\n')
+
+    def test_waits_for_zsh(self):
+        self.write(self.path, b': 100:0;ls\n')
+        self.write(self.path + '.LOCK', b'1')
+        original = self.d._history_lock
+        self.d._history_lock = lambda path: original(path, timeout=0.2)
+        self.assertEqual(self.d.history(), 1)
+        self.assertEqual(self.read(self.path), b': 100:0;ls\n')
+
+    def test_nothing_to_compact(self):
+        self.assertEqual(self.d.history(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+DOCK = '/Users/bob/Library/Preferences/com.apple.dock.plist'
+FINDER = '/Users/bob/Library/Preferences/com.apple.finder.plist'
+
+
+class CompileJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.LOG_LEVEL = -1
+        # the recorded user's plists, not the ones of whoever compiles it
+        self.d.USER_PATH = '/Users/someone-else'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def compile(self, *argvs):
+        journal_path = os.path.join(self.tmp, 'journal.jsonl')
+        with open(journal_path, 'w') as f:
+            f.write(json.dumps({ 'op': 'context', 'user': 'bob', 'user_path': '/Users/bob' }) + '\n')
+            for argv in argvs:
+                f.write(json.dumps({ 'op': 'run', 'argv': argv, 'cwd': '/Users/bob/dotfyles' }) + '\n')
+        with open(self.d.compile_journal(journal_path, os.path.join(self.tmp, 'journal.sh'))) as f:
+            # without the header, the 'sudo -v' and the 'cd'
+            return [ l for l in f.read().splitlines() if l and not l.startswith(('#', 'cd ', 'sudo -v')) ]
+
+    def test_one_plistbuddy_call_per_plist(self):
+        lines = self.compile(
+            ['defaults', 'write', 'com.apple.dock', 'autohide', '-bool', 'true'],
+            ['defaults', 'write', 'com.apple.finder', 'ShowPathbar', '-bool', 'true'],
+            ['defaults', 'write', 'com.apple.dock', 'tilesize', '-int', '36'],
+            ['killall', 'Dock'],
+        )
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('/usr/libexec/PlistBuddy -c'))
+        self.assertTrue(lines[0].endswith(DOCK + ' >/dev/null 2>&1'))
+        self.assertIn("'Add :\"autohide\" bool true'", lines[0])
+        self.assertIn("'Add :\"tilesize\" integer 36'", lines[0])
+        self.assertTrue(lines[1].endswith(FINDER + ' >/dev/null 2>&1'))
+        self.assertEqual(lines[2:], ['killall cfprefsd', 'killall Dock'])
+
+    def test_a_plist_with_an_untranslatable_write_is_replayed(self):
+        lines = self.compile(
+            ['defaults', 'write', 'com.apple.dock', 'autohide', '-bool', 'true'],
+            ['defaults', 'write', 'com.apple.dock', 'persistent-apps', '-array-add', '<dict/>'],
+            ['defaults', '-currentHost', 'write', 'com.apple.screensaver', 'idleTime', '-int', '0'],
+        )
+        self.assertEqual(lines, [
+            'defaults write com.apple.dock autohide -bool true',
+            "defaults write com.apple.dock persistent-apps -array-add '<dict/>'",
+            'defaults -currentHost write com.apple.screensaver idleTime -int 0',
+        ])
+
+    def test_system_plists_are_written_with_sudo(self):
+        lines = self.compile(
+            ['sudo', 'defaults', 'write', '/Library/Preferences/com.apple.alf', 'globalstate', '-int', '1'],
+            ['defaults', 'write', 'com.apple.dock', 'autohide', '-bool', 'true'],
+        )
+        self.assertTrue(lines[0].startswith('sudo /usr/libexec/PlistBuddy'))
+        self.assertIn('/Library/Preferences/com.apple.alf.plist', lines[0])
+        self.assertTrue(lines[1].startswith('/usr/libexec/PlistBuddy'))
+        self.assertEqual(lines[2:], ['killall cfprefsd', 'sudo killall cfprefsd'])
+
+    def test_deletes_and_repeats(self):
+        lines = self.compile(
+            ['defaults', 'delete', 'com.apple.dock', 'persistent-apps'],
+            ['killall', 'Dock'],
+            ['killall', 'Dock'],
+            ['defaults', 'write', 'com.apple.dock', 'autohide', '-bool', 'true'],
+            ['killall', 'Dock'],
+        )
+        self.assertIn("'Delete :\"persistent-apps\"'", lines[0])
+        # repeated back to back they run once, after a plist write they run again
+        self.assertEqual(lines[1:3], ['killall cfprefsd', 'killall Dock'])
+        self.assertEqual(lines[4:], ['killall cfprefsd', 'killall Dock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from support import REPO_PATH, load_dotfyles
+
+FAKE_JENV = """#!/bin/sh
+if [ "$1" = init ]; then
+  cat <<'INIT'
+export JENV_LOADED=1
+jenv() {
+  case "$1" in
+    shell) echo "shell integration $2" ;;
+    *) command jenv "$@" ;;
+  esac
+}
+INIT
+else
+  echo "jenv binary $*"
+fi
+"""
+
+FAKE_JAVA = """#!/bin/sh
+echo "java with JENV_LOADED=$JENV_LOADED"
+"""
+
+
+@unittest.skipIf(shutil.which('bash') is None, "bash is not installed")
+class LazyInitTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='dotfyles-test-')
+        bin_path = os.path.join(self.home, '.jenv', 'bin')
+        os.makedirs(bin_path)
+        for name, script in (('jenv', FAKE_JENV), ('java', FAKE_JAVA)):
+            with open(os.path.join(bin_path, name), 'w') as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_path, name), 0o755)
+
+        d = load_dotfyles()
+        d.USER_PATH = self.home
+        d.LOG_LEVEL = d.LOG_QUIET
+        d.shell__lazy_init()
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def shell(self, script):
+        # like a login shell: .profile sources the stubs, then defines its jenv() wrapper
+        env = { 'HOME': self.home, 'PATH': '/usr/bin:/bin' }
+        return subprocess.run(['bash', '-c', 'source ' + os.path.join(REPO_PATH, '.profile') + ' 2> /dev/null; ' + script],
+                              env=env, stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+
+    def test_stub_runs_the_init_once(self):
+        self.assertEqual(self.shell('java; java'), ['java with JENV_LOADED=1'] * 2)
+
+    def test_wrapper_survives_the_init(self):
+        out = self.shell('jenv-add-all() { echo "add-all"; }; java > /dev/null; jenv add-all; jenv shell 8')
+        self.assertEqual(out, ['add-all', 'shell integration 8'])
+
+    def test_jenv_shell_before_any_stub(self):
+        self.assertEqual(self.shell('jenv shell 11; jenv versions'), ['shell integration 11', 'jenv binary versions'])
+
+
+if __name__ == '__main__':
+    unittest.main()
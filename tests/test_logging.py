@@ -0,0 +1,82 @@
+import builtins
+import collections
+import io
+import json
+import threading
+import unittest
+
+from support import load_dotfyles
+
+
+class LoggingTest(unittest.TestCase):
+    def setUp(self):
+        self.d = load_dotfyles()
+        # nothing on stdout, everything in the NDJSON log
+        self.d.LOG_LEVEL = -1
+        self.d.LOG_JSON = io.StringIO()
+
+    def records(self):
+        self.d._log_flush()
+        return [ json.loads(line) for line in self.d.LOG_JSON.getvalue().splitlines() ]
+
+    def messages(self):
+        # without the '¡' and '⚠' in front
+        return [ r['message'].split(' ', 1)[1] for r in self.records() if r['kind'] in ('info', 'warn') ]
+
+    def steps(self, *steps):
+        self.d.STEPS = collections.OrderedDict((step.__name__, (step, None, [], True)) for step in steps)
+
+    def test_levels(self):
+        self.d._warn("careful")
+        self.d._info("hello")
+        self.d._debug("details")
+        self.assertEqual([ (r['kind'], r['level']) for r in self.records() ], [('warn', 'warn'), ('info', 'normal'), ('debug', 'verbose')])
+
+    def test_each_step_is_one_group(self):
+        def first():
+            self.d._info("first starts")
+            # e.g. a background task's thread, logging while the step runs
+            thread = threading.Thread(target=self.d._info, args=("meanwhile",))
+            thread.start()
+            thread.join()
+            self.d._info("first ends")
+        def second():
+            self.d._info("second")
+        self.steps(first, second)
+        self.d.run_steps()
+        self.assertEqual(self.messages(), ["meanwhile", "first starts", "first ends", "second"])
+
+    def test_a_failing_step_still_logs(self):
+        def failing():
+            self.d._warn("about to fail")
+            raise RuntimeError()
+        self.steps(failing)
+        with self.assertRaises(RuntimeError):
+            self.d.run_steps()
+        self.assertEqual(self.messages(), ["about to fail"])
+
+    def test_prompts_come_after_what_was_logged(self):
+        seen = []
+        def ask():
+            self.d._info("before the question")
+            self.d._question("name?")
+            self.d._info("after the question")
+        original = builtins.input
+        builtins.input = lambda msg: seen.append(self.d.LOG_JSON.getvalue()) or 'alice'
+        try:
+            self.steps(ask)
+            self.d.run_steps()
+        finally:
+            builtins.input = original
+        self.assertIn("before the question", seen[0])
+        self.assertEqual(self.messages(), ["before the question", "after the question"])
+
+    def test_discarded_groups_are_not_written(self):
+        with self.d._log_group(discard=True):
+            self.d._info("noise")
+            self.d._log_flush()
+        self.assertEqual(self.messages(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
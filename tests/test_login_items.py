@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+LISTED = """Alfred 3;/Applications/Alfred 3.app;true
+Dropbox;/Applications/Dropbox.app;false
+Caffeine;/Applications/Caffeine.app;true
+"""
+
+
+class StubScripts(object):
+    """Stands in for osascript: answers loginitems-ls and records the scripts it's given."""
+    def __init__(self, repo_path, listed):
+        self.ls, self.listed, self.calls = os.path.join(repo_path, 'loginitems-ls'), listed, []
+
+    def __call__(self, args):
+        self.calls.append(args)
+        return self.listed if args == [self.ls] else ''
+
+    def script(self):
+        return [ a for a in self.calls[-1] if a != '-e' ] if len(self.calls) > 1 else []
+
+
+class LoginItemsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.LOG_LEVEL = self.d.LOG_QUIET
+        self.d.USER_PATH = os.path.join(self.tmp, 'home')
+        self.d.REPO_PATH = os.path.join(self.tmp, 'repo')
+        os.makedirs(self.d.REPO_PATH)
+        # from elsewhere, the paths don't depend on the current directory
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def want(self, text):
+        with open(os.path.join(self.d.REPO_PATH, '.loginitems'), 'w') as f:
+            f.write(text)
+
+    def managed(self):
+        with open(os.path.join(self.d.USER_PATH, '.cache', 'dotfyles', 'loginitems.json')) as f:
+            return json.load(f)
+
+    def sync(self, listed):
+        stub = StubScripts(self.d.REPO_PATH, listed)
+        self.d.brew__login_items(run_script=stub)
+        return stub
+
+    def test_parse(self):
+        self.assertEqual(self.d._parse_login_items(LISTED + "\nnot an item\n"), [
+            ('Alfred 3', '/Applications/Alfred 3.app', True),
+            ('Dropbox', '/Applications/Dropbox.app', False),
+            ('Caffeine', '/Applications/Caffeine.app', True),
+        ])
+
+    def test_script_diff(self):
+        current = self.d._parse_login_items(LISTED)
+        wanted = [('Alfred 3', '/Applications/Alfred 3.app', True), ('Caffeine', '/Applications/Caffeine.app', False),
+                  ('Say "hi"', '/Applications/Say "hi".app', False)]
+        self.assertEqual(self.d._login_items_script(current, wanted, ['/Applications/Dropbox.app']), [
+            'delete login item "Dropbox"',
+            'delete login item "Caffeine"',
+            'make login item at end with properties {path:"/Applications/Caffeine.app", hidden:false}',
+            'make login item at end with properties {path:"/Applications/Say \\"hi\\".app", hidden:false}',
+        ])
+        # not added by us, so not ours to remove
+        self.assertEqual(self.d._login_items_script(current, wanted[:1]), [])
+
+    def test_sync_keeps_the_users_items(self):
+        self.want("Alfred 3;/Applications/Alfred 3.app;true\nSlack;/Applications/Slack.app;false\n")
+        stub = self.sync(LISTED)
+        self.assertEqual(stub.script(), ['tell application "System Events"',
+                                         'make login item at end with properties {path:"/Applications/Slack.app", hidden:false}',
+                                         'end tell'])
+        self.assertEqual(self.managed(), ['/Applications/Alfred 3.app', '/Applications/Slack.app'])
+
+        # dropped from .loginitems, so it goes, but Dropbox and Caffeine stay
+        self.want("Alfred 3;/Applications/Alfred 3.app;true\n")
+        stub = self.sync(LISTED + "Slack;/Applications/Slack.app;false\n")
+        self.assertEqual(stub.script(), ['tell application "System Events"', 'delete login item "Slack"', 'end tell'])
+        self.assertEqual(self.managed(), ['/Applications/Alfred 3.app'])
+
+    def test_in_sync(self):
+        self.want("Dropbox;/Applications/Dropbox.app;false\n")
+        stub = self.sync(LISTED)
+        self.assertEqual(len(stub.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
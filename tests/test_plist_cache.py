@@ -0,0 +1,72 @@
+import collections
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+
+class PlistCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.PLIST_CACHE = collections.OrderedDict()
+        self.d.PLIST_CACHE_SIZE = 0
+        self.d.PLIST_CACHE_STATS = collections.Counter()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name + '.plist')
+
+    def write(self, name, plist):
+        # not through _dump_plist, like another program changing it
+        with open(self.path(name), 'wb') as f:
+            plistlib.dump(plist, f, fmt=plistlib.FMT_BINARY)
+        return os.path.getsize(self.path(name))
+
+    def test_hit_and_miss(self):
+        self.write('a', {'k': 1})
+        self.assertEqual(self.d._load_plist(self.path('a')), {'k': 1})
+        self.assertIs(self.d._load_plist(self.path('a')), self.d._load_plist(self.path('a')))
+        self.assertEqual(self.d.PLIST_CACHE_STATS, {'misses': 1, 'hits': 2})
+        self.assertIsNone(self.d._load_plist(self.path('missing')))
+
+    def test_a_changed_file_replaces_its_entry(self):
+        self.write('a', {'k': 1})
+        self.d._load_plist(self.path('a'))
+        size = self.write('a', {'k': 'a longer value than before'})
+        self.assertEqual(self.d._load_plist(self.path('a')), {'k': 'a longer value than before'})
+        self.assertEqual(list(self.d.PLIST_CACHE), [self.path('a')])
+        self.assertEqual(self.d.PLIST_CACHE_SIZE, size)
+
+    def test_dump_replaces_its_entry(self):
+        self.d._dump_plist(self.path('a'), {'k': 1})
+        self.d._dump_plist(self.path('a'), {'k': 2})
+        self.assertEqual(list(self.d.PLIST_CACHE), [self.path('a')])
+        self.assertEqual(self.d._load_plist(self.path('a')), {'k': 2})
+        self.assertEqual(self.d.PLIST_CACHE_STATS['misses'], 0)
+
+    def test_evicts_the_least_recently_used(self):
+        sizes = { name: self.write(name, {'k': name * 100}) for name in 'abc' }
+        self.d.PLIST_CACHE_BYTES = sizes['a'] + sizes['b']
+        self.d._load_plist(self.path('a'))
+        self.d._load_plist(self.path('b'))
+        self.d._load_plist(self.path('a'))
+        self.d._load_plist(self.path('c'))
+        self.assertEqual(list(self.d.PLIST_CACHE), [self.path('a'), self.path('c')])
+        self.assertEqual(self.d.PLIST_CACHE_SIZE, sizes['a'] + sizes['c'])
+        self.assertEqual(self.d.PLIST_CACHE_STATS['evictions'], 1)
+
+    def test_keeps_one_entry_over_budget(self):
+        self.d.PLIST_CACHE_BYTES = 1
+        self.write('a', {'k': 1})
+        self.d._load_plist(self.path('a'))
+        self.assertEqual(list(self.d.PLIST_CACHE), [self.path('a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from support import load_dotfyles, plumbum
+
+
+@unittest.skipIf(plumbum is None, "plumbum is not installed")
+class RunAllTest(unittest.TestCase):
+    def setUp(self):
+        self.d = load_dotfyles()
+        self.d.plumbum = plumbum
+        self.d.local = self.d._Machine()
+        self.d.sudo = self.d.local['sudo']
+        self.d.LOG_LEVEL = -1
+        self.batches = []
+        self.retcodes = {}
+        # stands in for the helper, without sudo
+        self.d._privileged = self.privileged
+
+    def privileged(self, requests):
+        self.batches.append([ r['argv'] for r in requests ])
+        return [ { 'retcode': self.retcodes.get(r['argv'][0], 0), 'stdout': ' '.join(r['argv']), 'stderr': '' } for r in requests ]
+
+    def test_one_round_trip(self):
+        pmset, defaults = self.d.sudo[self.d.local['pmset']], self.d.sudo[self.d.local['defaults']]
+        results = self.d._run_all([ pmset['-a', 'sms', '0'], defaults['write', '/Library/Preferences/com.apple.alf', 'globalstate', '-int', '1'] ])
+        self.assertEqual(self.batches, [[['pmset', '-a', 'sms', '0'], ['defaults', 'write', '/Library/Preferences/com.apple.alf', 'globalstate', '-int', '1']]])
+        self.assertEqual([ r[1] for r in results ], ['pmset -a sms 0', 'defaults write /Library/Preferences/com.apple.alf globalstate -int 1'])
+
+    def test_failures_are_raised_after_the_batch(self):
+        self.retcodes['chflags'] = 1
+        cmds = [ self.d.sudo[self.d.local['chflags']]['nouchg', '/nope'], self.d.sudo[self.d.local['pmset']]['-a', 'sms', '0'] ]
+        with self.assertRaises(plumbum.commands.processes.ProcessExecutionError):
+            self.d._run_all(cmds)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.d._run_all(cmds, retcode=None)), 2)
+
+    def test_mixed_commands_run_one_by_one(self):
+        results = self.d._run_all([ self.d.sudo[self.d.local['pmset']]['-a', 'sms', '0'], self.d.local['true'] ])
+        self.assertEqual(self.batches, [[['pmset', '-a', 'sms', '0']]])
+        self.assertEqual(results[1][0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
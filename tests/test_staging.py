@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from support import REPO_PATH, plumbum, staged_dotfyles
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        yield b'# fetched\nfetched-pattern\n'
+
+
+def snapshot(path):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            if not os.path.islink(full):
+                with open(full, 'rb') as f:
+                    files[os.path.relpath(full, path)] = hashlib.sha256(f.read()).hexdigest()
+    return files
+
+
+@unittest.skipIf(plumbum is None, "plumbum is not installed")
+class StagingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        # a checkout of our own, with the tmux submodule in place
+        self.repo = os.path.join(self.tmp, 'repo')
+        shutil.copytree(REPO_PATH, self.repo, ignore=shutil.ignore_patterns('.git', 'Alfred.alfredpreferences', 'tests', '__pycache__', '.pytest_cache'))
+        os.makedirs(os.path.join(self.repo, '.tmux'), exist_ok=True)
+        with open(os.path.join(self.repo, '.tmux', '.tmux.conf'), 'w') as f:
+            f.write('# tmux\n')
+        self.cwd = os.getcwd()
+        os.chdir(self.repo)
+
+        self.d = staged_dotfyles(self.tmp)
+        self.d.REPO_PATH = self.repo
+        self.d.requests = types.SimpleNamespace(get=lambda url, **kwargs: FakeResponse())
+        self.d.DOWNLOADS_CACHE_PATH = os.path.join(self.tmp, 'downloads')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_staged_run_leaves_the_repo_untouched(self):
+        before = snapshot(self.repo)
+        self.d.update_gitignore()
+        self.d.shell()
+        self.assertEqual(before, snapshot(self.repo))
+
+        # what would have gone into the repo is in its mirror under the root
+        staged = os.path.join(self.d.ROOT_PATH, self.repo.lstrip(os.sep))
+        with open(os.path.join(staged, '.gitignore')) as f:
+            gitignore = f.read()
+        with open(os.path.join(self.repo, '.gitignore')) as f:
+            own = f.read().split('#######################\n#######################', 1)[0]
+        self.assertTrue(gitignore.startswith(own))
+        self.assertIn('fetched-pattern', gitignore)
+        self.assertTrue(os.path.exists(os.path.join(staged, '.tmux.conf')))
+        self.assertEqual(os.readlink(self.d._abspath('~/.tmux.conf')), os.path.join(self.repo, '.tmux.conf'))
+
+    def test_staged_runs_build_on_the_staged_gitignore(self):
+        staged_path = os.path.join(self.d.ROOT_PATH, self.repo.lstrip(os.sep), '.gitignore')
+        self.d.update_gitignore()
+        with open(staged_path) as f:
+            first = f.read()
+        self.d.FORCE = True
+        self.d.update_gitignore()
+        # the fetched part is rebuilt, not appended to the previous one
+        with open(staged_path) as f:
+            self.assertEqual(first, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
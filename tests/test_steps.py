@@ -0,0 +1,68 @@
+import inspect
+import types
+import unittest
+
+from support import load_dotfyles
+
+
+class StepsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.d = load_dotfyles()
+
+    def test_every_step_is_registered(self):
+        d = self.d
+        # the steps are the public functions from the first registered one to the last
+        lines = [ inspect.unwrap(step).__code__.co_firstlineno for step, _, _, _ in d.STEPS.values() ]
+        first, last = min(lines), max(lines)
+        for name, func in vars(d).items():
+            if not isinstance(func, types.FunctionType) or name.startswith('_') or func.__globals__ is not vars(d):
+                continue
+            if not first <= inspect.unwrap(func).__code__.co_firstlineno <= last:
+                continue
+            # group runners, the helpers of a step (shell__plugins) and --bench-shell aren't steps
+            if name in d.STEP_GROUPS or name.split('__')[0] in d.STEPS or name == 'bench_shell':
+                continue
+            self.assertIn(name, d.STEPS)
+
+    def test_needs_are_registered(self):
+        for name, (step, group, needs, full) in self.d.STEPS.items():
+            for need in needs:
+                self.assertIn(need, self.d.STEPS, name)
+                self.assertLess(list(self.d.STEPS).index(need), list(self.d.STEPS).index(name), name)
+
+    def test_full_run(self):
+        plan = self.d.resolve_steps()
+        self.assertEqual(plan, [ (n, 'run') for n, s in self.d.STEPS.items() if s[3] ])
+        self.assertNotIn(('conf_osx__login', 'run'), plan)
+        self.assertNotIn(('bartender', 'run'), plan)
+
+    def test_needs_come_first(self):
+        self.assertEqual(self.d.resolve_steps(['conf_osx__dock']), [('conf_osx__prepare', 'run'), ('conf_osx__dock', 'run')])
+        self.assertEqual(self.d.resolve_steps(['conf_osx__login']), [('conf_osx__prepare', 'run'), ('conf_osx__login', 'run')])
+
+    def test_needs_with_a_loader_are_loaded(self):
+        self.assertEqual(self.d.resolve_steps(['git']), [('personal_info', 'load'), ('git', 'run')])
+        self.assertEqual(self.d.resolve_steps(['git', 'personal_info']), [('personal_info', 'run'), ('git', 'run')])
+        self.assertEqual(self.d.resolve_steps(['conf_osx__hardware']), [('check_sip', 'load'), ('conf_osx__prepare', 'run'), ('conf_osx__hardware', 'run')])
+
+    def test_order_follows_the_registry(self):
+        plan = self.d.resolve_steps(['teardown', 'bartender', 'shell'])
+        self.assertEqual([ n for n, _ in plan ], ['shell', 'bartender', 'teardown'])
+
+    def test_groups_and_skip(self):
+        plan = [ n for n, _ in self.d.resolve_steps(['conf_osx'], ['conf_osx__dock']) ]
+        self.assertIn('conf_osx__finder', plan)
+        self.assertNotIn('conf_osx__dock', plan)
+        self.assertNotIn('conf_osx__spotlight', plan)
+        self.assertEqual(plan[:2], ['check_sip', 'conf_osx__prepare'])
+        # skipping what others need leaves it out, it isn't pulled back in
+        self.assertNotIn('conf_osx__prepare', [ n for n, _ in self.d.resolve_steps(['conf_osx__dock'], ['conf_osx__prepare']) ])
+
+    def test_unknown_step(self):
+        with self.assertRaises(ValueError):
+            self.d.resolve_steps(['nope'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import load_dotfyles
+
+
+class SyncTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.d = load_dotfyles()
+        self.d.JOURNAL = []
+        self.src = os.path.join(self.tmp, 'src')
+        self.dst = os.path.join(self.tmp, 'dst')
+        self.write('src/prefs.json', b'{}')
+        self.write('src/workflows/a/info.plist', b'workflow a')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, rel, data):
+        path = os.path.join(self.tmp, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def tree(self, path):
+        files = {}
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                with open(os.path.join(dirpath, name), 'rb') as f:
+                    files[os.path.relpath(os.path.join(dirpath, name), path)] = f.read()
+        return files
+
+    def sync(self):
+        return dict(self.d._sync_tree(self.src, self.dst))
+
+    def test_first_sync_copies_everything(self):
+        self.assertEqual(self.sync(), { 'files': 2, 'copied': 2, 'bytes': 12 })
+        self.assertEqual(self.tree(self.dst), self.tree(self.src))
+        self.assertEqual(self.d.JOURNAL, [{ 'op': 'sync', 'src': self.src, 'dst': self.dst }])
+
+    def test_unchanged_files_are_left_alone(self):
+        self.sync()
+        self.assertEqual(self.sync(), { 'files': 2 })
+        # nothing changed, nothing to replay
+        self.assertEqual(len(self.d.JOURNAL), 1)
+
+    def test_changed_and_stale_files(self):
+        self.sync()
+        self.write('src/prefs.json', b'{"theme": 1}')
+        self.write('dst/workflows/b/info.plist', b'removed from the repo')
+        self.assertEqual(self.sync(), { 'files': 2, 'copied': 1, 'bytes': 12, 'removed': 1 })
+        self.assertEqual(self.tree(self.dst), self.tree(self.src))
+
+    def test_same_size_different_content(self):
+        self.sync()
+        self.write('dst/prefs.json', b'[]')
+        # an older mtime, so the size and time don't settle it and it gets hashed
+        os.utime(os.path.join(self.dst, 'prefs.json'), (0, 0))
+        self.assertEqual(self.sync()['copied'], 1)
+        self.assertEqual(self.tree(self.dst), self.tree(self.src))
+
+    def test_a_dir_replaced_by_a_file(self):
+        self.sync()
+        shutil.rmtree(os.path.join(self.src, 'workflows'))
+        self.write('src/workflows', b'now a file')
+        self.sync()
+        self.assertEqual(self.tree(self.dst), self.tree(self.src))
+
+    def test_missing_src(self):
+        shutil.rmtree(self.src)
+        self.assertEqual(self.sync(), {})
+        self.assertFalse(os.path.exists(self.dst))
+
+
+if __name__ == '__main__':
+    unittest.main()
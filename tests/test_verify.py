@@ -0,0 +1,101 @@
+import os
+import plistlib
+import shutil
+import tempfile
+import types
+import unittest
+
+from support import REPO_PATH, plumbum, staged_dotfyles
+
+
+class FakeResponse(object):
+    status_code = 200
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        yield b'fetched\n'
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@unittest.skipIf(plumbum is None, "plumbum is not installed")
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='dotfyles-test-')
+        self.repo = os.path.join(self.tmp, 'repo')
+        shutil.copytree(REPO_PATH, self.repo, ignore=shutil.ignore_patterns('.git', 'Alfred.alfredpreferences', 'tests', '__pycache__', '.pytest_cache'))
+        write(os.path.join(self.repo, 'Alfred.alfredpreferences', 'prefs.plist'), b'prefs')
+        write(os.path.join(self.repo, 'Alfred.alfredpreferences', 'workflows', 'a', 'info.plist'), b'workflow')
+        write(os.path.join(self.repo, 'com.googlecode.iterm2.plist'), plistlib.dumps({'Default Bookmark Guid': 'x', 'TabStyle': 1}))
+        self.cwd = os.getcwd()
+        os.chdir(self.repo)
+
+        self.d = staged_dotfyles(self.tmp)
+        self.d.REPO_PATH = self.repo
+        self.d.requests = types.SimpleNamespace(get=lambda url, **kwargs: FakeResponse())
+        self.d.DOWNLOADS_CACHE_PATH = os.path.join(self.tmp, 'downloads')
+        self.d.ANSWERS = { 'github_token': 'token' }
+        self.d.USER_NAME, self.d.USER_EMAIL, self.d.GITHUB_USR = 'Alice', 'alice@example.com', 'alice'
+        self.steps = [self.d.git, self.d.alfred, self.d.iterm]
+        for step in self.steps:
+            step()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def audit(self):
+        expected, errors = self.d.collect_expected(self.steps)
+        self.assertEqual(errors, [])
+        return { r['path']: r['status'] for r in self.d.audit(expected) if r['kind'] != 'defaults' }
+
+    def test_staged_run_verifies_clean(self):
+        results = self.audit()
+        self.assertEqual({ p for p, s in results.items() if s != 'ok' }, set())
+        # the git links and every file of the Alfred tree are checked
+        self.assertIn(self.d._abspath('~/.gitconfig'), results)
+        self.assertIn(self.d._abspath('~/.gitignore'), results)
+        alfred = self.d._abspath('~/Library/Application Support/Alfred 3/Alfred.alfredpreferences')
+        self.assertIn(os.path.join(alfred, 'prefs.plist'), results)
+        self.assertIn(os.path.join(alfred, 'workflows', 'a', 'info.plist'), results)
+
+    def test_alfred_drift(self):
+        alfred = self.d._abspath('~/Library/Application Support/Alfred 3/Alfred.alfredpreferences')
+        write(os.path.join(alfred, 'prefs.plist'), b'changed in the app')
+        os.remove(os.path.join(alfred, 'workflows', 'a', 'info.plist'))
+        results = self.audit()
+        self.assertEqual(results[os.path.join(alfred, 'prefs.plist')], 'drift')
+        self.assertEqual(results[os.path.join(alfred, 'workflows', 'a', 'info.plist')], 'missing')
+
+    def test_iterm_plist_is_compared_parsed(self):
+        path = self.d._user_defaults('com.googlecode.iterm2')
+        with open(path, 'rb') as f:
+            plist = plistlib.load(f)
+        # the same contents in other bytes (cfprefsd writes them back its own way)
+        write(path, plistlib.dumps(plist, fmt=plistlib.FMT_XML))
+        self.assertEqual(self.audit()[path], 'ok')
+
+        plist['TabStyle'] = 2
+        write(path, plistlib.dumps(plist, fmt=plistlib.FMT_BINARY))
+        self.assertEqual(self.audit()[path], 'drift')
+
+    def test_the_gitignore_is_left_alone(self):
+        # auditing doesn't fetch the remote lists again
+        self.d.requests = None
+        self.audit()
+
+
+if __name__ == '__main__':
+    unittest.main()